@@ -0,0 +1,431 @@
+"""
+In-process interface to py9backup, for programs managing many groups.
+
+Unlike the command line interface, nothing here prompts or exits: errors are
+raised as BackupError, and the config directory and settings are passed
+explicitly. A Backup keeps the results of resolving its groups (glob
+expansions, directory listings and stats) between calls, so that a long-lived
+process does not pay for them every time when listing or checking files. Call
+Backup.clear_caches when the files on disk may have changed. Pulls always
+resolve against the disk, so that they never miss new files.
+
+    from py9backup.api import Backup
+
+    bk = Backup("~/.config/py9backup")
+    home = bk.group("home")
+    home.add(["~/documents", "~/**/*.bak"])
+    if "~/documents/cv.pdf" in home:
+        tar_fn = home.pull("/mnt/backups")
+"""
+
+from __future__ import annotations
+
+import os
+import os.path as osp
+from pathlib import Path
+from typing import TYPE_CHECKING, Dict, Iterable, List, Optional, Tuple, Union
+
+from .backup import (
+    STAT_WORKERS,
+    BackupError,
+    DISK,
+    CachedFileSystem,
+    Catalog,
+    PathMatcher,
+    PullGovernor,
+    RichPath,
+    add_paths,
+    canonicalize_group_name,
+    commit_group_rps,
+    compact_rps,
+    get_backup_fp,
+    get_group_manifest_file,
+    get_group_rps,
+    iter_archive_paths,
+    load_settings,
+    make_path_filter,
+    pull_paths,
+    remove_paths,
+    resolve_group,
+    restore_archive,
+)
+
+if TYPE_CHECKING:
+    import configparser as ini
+
+__all__ = ["Backup", "BackupError", "Group"]
+
+
+class Backup:
+    """
+    The groups in one config directory.
+    """
+
+    def __init__(
+        self,
+        config_dir: Union[str, Path],
+        *,
+        settings: Optional[ini.ConfigParser] = None,
+        restore_backups=False,
+    ) -> None:
+        """
+        Args:
+            config_dir: the config directory holding the groups.
+            settings: the settings to use, instead of the settings.ini in
+                config_dir.
+            restore_backups: whether to restore the backup of a group whose
+                manifest is missing, which the command line interface asks
+                about.
+        """
+        self.config_dir = Path(config_dir).expanduser()
+        self.restore_backups = restore_backups
+        self.fs = CachedFileSystem()
+
+        self._settings = settings
+        self._groups: Dict[str, Group] = {}
+
+    @property
+    def settings(self) -> ini.ConfigParser:
+        if self._settings is None:
+            self._settings = load_settings(self.config_dir)
+        return self._settings
+
+    def groups(self) -> List[str]:
+        """
+        Lists the known groups.
+        """
+        return sorted(path.stem for path in self.config_dir.glob("*.txt"))
+
+    def group(self, name: str) -> Group:
+        """
+        Gets a group, which need not exist yet.
+        """
+        name = canonicalize_group_name(name)
+        if name not in self._groups:
+            self._groups[name] = Group(self, name)
+        return self._groups[name]
+
+    def clear_caches(self) -> None:
+        """
+        Forgets everything learned about the files on disk.
+        """
+        self.fs.clear()
+
+    def __repr__(self) -> str:
+        return f"Backup({str(self.config_dir)!r})"
+
+
+class Group:
+    """
+    A group of a Backup. Get these with Backup.group.
+
+    The group's manifest is read again whenever it changes on disk, so groups
+    can be changed by other processes in the meantime.
+    """
+
+    def __init__(self, backup: Backup, name: str) -> None:
+        self.backup = backup
+        self.name = name
+
+        # the manifest's (mtime, size) when last read, and what was read
+        self._manifest_key: Optional[Tuple[int, int]] = None
+        self._rps: List[RichPath] = []
+        self._matcher: Optional[PathMatcher] = None
+
+    @property
+    def manifest_file(self) -> Path:
+        return get_group_manifest_file(
+            self.name,
+            need_exist=False,
+            check_backup=False,
+            config_dir=self.backup.config_dir,
+        )
+
+    @property
+    def exists(self) -> bool:
+        return self.manifest_file.exists()
+
+    def rich_paths(self) -> List[RichPath]:
+        """
+        Returns:
+            the rich paths in the group's manifest.
+
+        Raises:
+            BackupError: if the group does not exist.
+        """
+        # restores the backup if the manifest is gone
+        fp = get_group_manifest_file(
+            self.name,
+            config_dir=self.backup.config_dir,
+            restore_backup=self.backup.restore_backups,
+        )
+        try:
+            st = fp.stat()
+        except FileNotFoundError:
+            raise BackupError(f'Group "{self.name}" does not exist.')
+
+        key = (st.st_mtime_ns, st.st_size)
+        if key != self._manifest_key:
+            self._rps = get_group_rps(
+                self.name, config_dir=self.backup.config_dir
+            )
+            self._matcher = None
+            self._manifest_key = key
+
+        return list(self._rps)
+
+    @property
+    def _auto_compact(self) -> bool:
+        # from the Backup's settings, rather than whatever is on disk
+        return self.backup.settings.getboolean(
+            "py9backup", "auto_compact", fallback=False
+        )
+
+    def add(
+        self,
+        paths: Iterable[str],
+        *,
+        exclude=False,
+        allow_nx=False,
+        glob: Optional[bool] = None,
+    ) -> List[str]:
+        """
+        Adds paths to the group, creating it if needed, see the add command.
+
+        Returns:
+            the paths that were dropped because they do not exist.
+        """
+        return add_paths(
+            self.name,
+            [osp.expanduser(path) for path in paths],
+            exclude=exclude,
+            allow_nx=allow_nx,
+            glob=glob,
+            config_dir=self.backup.config_dir,
+            restore_backup=self.backup.restore_backups,
+            compact=self._auto_compact,
+        )
+
+    def remove(self, regex: str) -> List[RichPath]:
+        """
+        Removes the rich paths matching a regex, see the del command.
+
+        Returns:
+            the removed rich paths.
+        """
+        return remove_paths(
+            self.name,
+            regex,
+            config_dir=self.backup.config_dir,
+            compact=self._auto_compact,
+        )
+
+    def compact(self, dry_run=False) -> List[RichPath]:
+        """
+        Removes the rich paths that make no difference, see the compact
+        command.
+
+        Returns:
+            the removed rich paths.
+        """
+        rps = self.rich_paths()
+        kept = compact_rps(rps)
+        if not dry_run and len(kept) < len(rps):
+            commit_group_rps(
+                self.name,
+                kept,
+                existing=(rp.str for rp in kept if not rp.is_glob),
+                config_dir=self.backup.config_dir,
+                compact=False,
+            )
+        kept_set = set(kept)
+        return [rp for rp in rps if rp not in kept_set]
+
+    def resolve(
+        self, resolve: str = "expand", *, cached=True
+    ) -> Tuple[List[str], Optional[PathMatcher]]:
+        """
+        Resolves the group, see resolve_group.
+
+        Args:
+            cached: whether to use the Backup's caches, rather than the disk.
+        """
+        fs = self.backup.fs if cached else DISK
+        return resolve_group(self.rich_paths(), resolve, fs)
+
+    def files(self) -> List[str]:
+        """
+        Lists every path in the group, as it would be archived.
+        """
+        roots, matcher = self.resolve("filter")
+        return list(iter_archive_paths(roots, matcher, self.backup.fs))
+
+    def matcher(self) -> PathMatcher:
+        """
+        Returns:
+            a matcher for the group's rules, see PathMatcher.compile.
+        """
+        rps = self.rich_paths()
+        if self._matcher is None:
+            self._matcher = PathMatcher.compile(rps)
+        return self._matcher
+
+    def __contains__(self, path: str) -> bool:
+        """
+        Checks whether a path is backed up by the group, without touching the
+        disk, see the check command.
+        """
+        return Path(path).expanduser().absolute().as_posix() in self.matcher()
+
+    def _governor(self, governed: Optional[bool]) -> Optional[PullGovernor]:
+        settings = self.backup.settings
+        if governed is None:
+            governed = settings.getboolean(
+                PullGovernor.SECTION, "enabled", fallback=False
+            )
+        return PullGovernor.from_settings(settings) if governed else None
+
+    def pull(
+        self,
+        dest_dir: Union[str, Path],
+        *,
+        name: Optional[str] = None,
+        compalgo: Optional[str] = "gz",
+        resolve: str = "expand",
+        governed: Optional[bool] = None,
+        resume=False,
+        rsyncable=False,
+        catalog=True,
+        dedup=False,
+        progress: Optional[str] = None,
+    ) -> str:
+        """
+        Archives the group into dest_dir, see the pull command.
+
+        The group is resolved against the disk rather than the Backup's
+        caches, so that files created since are archived too. Governors only
+        throttle reads, since changing the priorities of the calling process
+        is left to the caller. If progress is given ("bar" or "json"),
+        progress is reported on stderr, see PullProgress.
+
+        Returns:
+            the path of the archive.
+        """
+        from datetime import date
+        from shutil import move
+
+        if name is None:
+            name = f"backup_{self.name}_{date.today().isoformat()}"
+        tar_name = f"{name}.tar" + (f".{compalgo}" if compalgo else "")
+        dest_fn = osp.join(dest_dir, tar_name)
+        if osp.lexists(dest_fn):
+            raise BackupError(f"{dest_fn} already exists. Pick another name.")
+
+        file_paths, matcher = self.resolve(resolve, cached=False)
+
+        catalog_db = Catalog(self.backup.config_dir) if catalog else None
+        try:
+            tar_fn, ckpt = pull_paths(
+                self.name,
+                file_paths,
+                matcher,
+                name=name,
+                compalgo=compalgo,
+                resume=resume,
+                governor=self._governor(governed),
+                rsyncable=rsyncable,
+                catalog=catalog_db,
+                dedup=dedup,
+                progress=progress,
+                config_dir=self.backup.config_dir,
+            )
+        finally:
+            if catalog_db is not None:
+                catalog_db.close()
+
+        try:
+            os.makedirs(dest_dir, exist_ok=True)
+            move(tar_fn, dest_fn)
+        except BaseException:
+            # the archive is still there, for pull(resume=True)
+            ckpt.release()
+            raise
+        ckpt.discard()
+        return dest_fn
+
+    def mirror(
+        self,
+        mirror_dir: Union[str, Path],
+        *,
+        name: Optional[str] = None,
+        resolve: str = "expand",
+        governed: Optional[bool] = None,
+    ) -> str:
+        """
+        Snapshots the group into mirror_dir, see the pull command's --mirror.
+        Like pull, this does not use the Backup's caches.
+
+        Returns:
+            the path of the snapshot.
+        """
+        from datetime import date
+
+        if name is None:
+            name = f"backup_{self.name}_{date.today().isoformat()}"
+        file_paths, matcher = self.resolve(resolve, cached=False)
+
+        target, _ = pull_paths(
+            self.name,
+            file_paths,
+            matcher,
+            name=name,
+            compalgo=None,
+            mirror=str(mirror_dir),
+            governor=self._governor(governed),
+            config_dir=self.backup.config_dir,
+        )
+        return target
+
+    def restore(
+        self,
+        archive: Union[str, Path],
+        dest: Union[str, Path],
+        *,
+        paths: Iterable[str] = (),
+        workers=STAT_WORKERS,
+        fsync=False,
+    ) -> Tuple[int, int]:
+        """
+        Restores the files an archive holds that the group backs up, see the
+        restore command.
+
+        Args:
+            archive: the archive to restore from.
+            dest: the directory to restore into.
+            paths: if given, only restore files at or below these paths.
+            workers: the number of threads writing files.
+            fsync: whether to wait for the restored files to be on disk.
+
+        Returns:
+            the number of restored files, and the number of bytes in them.
+        """
+        return restore_archive(
+            str(archive),
+            str(dest),
+            select=make_path_filter(paths, self.matcher()),
+            workers=workers,
+            fsync=fsync,
+        )
+
+    def forget(self, drop_backup=False) -> None:
+        """
+        Deletes the group's manifest, and its backup if drop_backup is set.
+        """
+        fp = self.manifest_file
+        fp.unlink(missing_ok=True)
+        if drop_backup:
+            get_backup_fp(fp).unlink(missing_ok=True)
+        self._manifest_key = None
+
+    def __repr__(self) -> str:
+        return f"Group({self.name!r})"
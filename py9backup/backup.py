@@ -2,27 +2,29 @@
 """
 Dead simple backup functionality.
 """
+
 from __future__ import annotations
-import configparser as ini
+
+# Only modules needed by every command are imported here. Everything else
+# (tarfile, glob, configparser, ...) is imported by the functions using it,
+# so that metadata commands like `list` and `show` start quickly.
+import errno
 import os
 import os.path as osp
 import re
 import string
 import sys
-import tarfile
-import tempfile as tmp
+import time
 from collections import defaultdict
-from dataclasses import dataclass
-from datetime import date
+from dataclasses import dataclass, field
 from functools import cached_property, lru_cache
-from glob import iglob
-from heapq import merge
 from itertools import groupby
 from pathlib import Path
-from shutil import copy as fcopy, rmtree
-from traceback import format_stack
 from typing import (
+    TYPE_CHECKING,
     Any,
+    Callable,
+    Deque,
     Dict,
     Generator,
     Iterable,
@@ -30,15 +32,27 @@ from typing import (
     NoReturn,
     Optional,
     Set,
+    TextIO,
     Tuple,
 )
 
 import click
 from click import Choice, echo
 
+if TYPE_CHECKING:
+    import configparser as ini
+    import tarfile
+
 DIE_CODE = -1
 
 
+class BackupError(Exception):
+    """
+    An error the user can act on. The command line interface reports these
+    with die, while library users can catch them, see py9backup.api.
+    """
+
+
 def die(msg) -> NoReturn:
     echo(msg, file=sys.stderr)
     sys.exit(DIE_CODE)
@@ -46,22 +60,78 @@ def die(msg) -> NoReturn:
 
 def soft_assert(expr: Any, msg: str) -> None:
     if not bool(expr):
+        from traceback import format_stack
+
         die(
             "The program has encountered an invalid state. "
             "Please report the following trace as an issue at "
             "https://github.com/qdbp/py9backup\nMessage:\n"
             + msg
             + "\n"
-            + format_stack()
+            + "".join(format_stack())
         )
 
 
 ALLOWABLE_CHARS = set(string.ascii_letters) | set(string.digits) | {"_"}
 CONFIG_DIR = Path("~/.config/py9backup/").expanduser()
 
+# number of threads used for bulk file system queries. these mostly wait on
+# the kernel, so this can be well above the number of cores.
+STAT_WORKERS = 16
+# below this many items, bulk queries are not worth spinning up threads for
+PARALLEL_THRESHOLD = 256
+# pulls are checkpointed whenever this many bytes were archived since the
+# last checkpoint. each checkpoint restarts compression, costing a little
+# compression ratio.
+CHECKPOINT_BYTES = 64 << 20
+# file contents are archived in chunks of this size
+COPY_CHUNK = 1 << 20
+# rsyncable archives restart compression before one in this many members on
+# average, and every this many bytes of file data, see is_sync_point
+RSYNC_MEMBER_INTERVAL = 32
+RSYNC_BLOCK = 1 << 20
+# restores hand at most this many bytes, and files, to the writing threads
+# before waiting for them to catch up
+RESTORE_BUFFER = 64 << 20
+RESTORE_QUEUE = 4096
+# pull progress is reported at most this often, in seconds
+PROGRESS_INTERVAL = 0.5
+# errors signifying that the kernel cannot copy between two given files
+KERNEL_COPY_ERRNOS = {
+    errno.EXDEV,
+    errno.ENOSYS,
+    errno.EINVAL,
+    errno.EOPNOTSUPP,
+    errno.EBADF,
+}
+
+
+def ensure_config_dir(config_dir: Optional[Path] = None) -> Path:
+    """
+    Creates the config directory if needed.
+
+    Args:
+        config_dir: the config directory, CONFIG_DIR if None. Every function
+            taking a config_dir defaults to CONFIG_DIR the same way.
+
+    Returns:
+        the config directory.
+    """
+    if config_dir is None:
+        config_dir = CONFIG_DIR
+    # noinspection PyBroadException
+    try:
+        config_dir.mkdir(parents=True, exist_ok=True)
+    except Exception:
+        raise BackupError(f"Unable to create config directory at {config_dir}")
+    return config_dir
+
 
-def load_settings() -> ini.ConfigParser:
-    settings_fn = CONFIG_DIR.joinpath("settings.ini")
+def load_settings(config_dir: Optional[Path] = None) -> ini.ConfigParser:
+    import configparser as ini
+
+    config_dir = ensure_config_dir(config_dir)
+    settings_fn = config_dir.joinpath("settings.ini")
     settings_fn.touch()
 
     parser = ini.ConfigParser()
@@ -70,7 +140,54 @@ def load_settings() -> ini.ConfigParser:
     return parser
 
 
-@lru_cache(maxsize=1 << 10)
+def parallel_map(func: Callable[[Any], Any], items: Iterable[Any]) -> List[Any]:
+    """
+    Maps func over items using a thread pool, preserving order.
+
+    Meant for file system queries, which release the GIL. Items are handed to
+    the workers in chunks, so that large inputs don't drown in the per-task
+    overhead of the executor.
+    """
+
+    items = list(items)
+    if len(items) < PARALLEL_THRESHOLD:
+        return [func(item) for item in items]
+
+    from concurrent.futures import ThreadPoolExecutor
+
+    chunk_size = -(-len(items) // (4 * STAT_WORKERS))
+    chunks = [
+        items[ix : ix + chunk_size] for ix in range(0, len(items), chunk_size)
+    ]
+
+    with ThreadPoolExecutor(max_workers=STAT_WORKERS) as pool:
+        return [
+            out
+            for chunk_out in pool.map(
+                lambda chunk: [func(item) for item in chunk], chunks
+            )
+            for out in chunk_out
+        ]
+
+
+def lstat_paths(paths: List[str]) -> List[Optional[os.stat_result]]:
+    """
+    Stats paths in parallel, without following links.
+
+    Returns:
+        the stat results, or None for paths that could not be stat'ed.
+    """
+
+    def lstat(path: str) -> Optional[os.stat_result]:
+        try:
+            return os.lstat(path)
+        except OSError:
+            return None
+
+    return parallel_map(lstat, paths)
+
+
+@lru_cache(maxsize=1 << 16)
 def is_glob(segment: str):
     return bool(re.search(r"(?<!\\)\*", segment))
 
@@ -113,6 +230,80 @@ def calc_raw_path_priority(path: str) -> int:
     return sum([1 - int(is_glob(s)) for s in segments])
 
 
+class FileSystem:
+    """
+    The file system queries made while resolving groups, passed through to
+    the disk. See CachedFileSystem.
+    """
+
+    def iglob(self, pattern: str) -> Iterable[str]:
+        from glob import iglob
+
+        return iglob(pattern, recursive=True)
+
+    def listdir(self, path: str) -> List[str]:
+        return os.listdir(path)
+
+    def isdir(self, path: str) -> bool:
+        return osp.isdir(path)
+
+    def islink(self, path: str) -> bool:
+        return osp.islink(path)
+
+
+class CachedFileSystem(FileSystem):
+    """
+    A FileSystem remembering its answers, for long-lived processes resolving
+    groups over and over. Changes on disk are not seen until clear is called.
+    """
+
+    def __init__(self) -> None:
+        self.globs: Dict[str, List[str]] = {}
+        self.listings: Dict[str, List[str]] = {}
+        # stat results, following links and not, or None for missing paths
+        self.stats: Dict[Tuple[str, bool], Optional[os.stat_result]] = {}
+
+    def clear(self) -> None:
+        self.globs.clear()
+        self.listings.clear()
+        self.stats.clear()
+
+    def stat(self, path: str, follow_symlinks=True) -> Optional[os.stat_result]:
+        key = (path, follow_symlinks)
+        if key not in self.stats:
+            try:
+                self.stats[key] = os.stat(path, follow_symlinks=follow_symlinks)
+            except (OSError, ValueError):
+                self.stats[key] = None
+        return self.stats[key]
+
+    def iglob(self, pattern: str) -> Iterable[str]:
+        if pattern not in self.globs:
+            self.globs[pattern] = list(super().iglob(pattern))
+        return self.globs[pattern]
+
+    def listdir(self, path: str) -> List[str]:
+        if path not in self.listings:
+            self.listings[path] = super().listdir(path)
+        return self.listings[path]
+
+    def isdir(self, path: str) -> bool:
+        import stat
+
+        st = self.stat(path)
+        return st is not None and stat.S_ISDIR(st.st_mode)
+
+    def islink(self, path: str) -> bool:
+        import stat
+
+        st = self.stat(path, follow_symlinks=False)
+        return st is not None and stat.S_ISLNK(st.st_mode)
+
+
+# the default, uncached file system
+DISK = FileSystem()
+
+
 @dataclass(frozen=True, order=False)
 class ReducedPath:
     """
@@ -181,7 +372,7 @@ class RichPath:
             return self.raw_entry
 
     def iter_reduced(
-        self,
+        self, fs: FileSystem = DISK
     ) -> Generator[ReducedPath, None, None]:
         """
         Generates the reduced paths of this RP according to their net priority.
@@ -190,6 +381,9 @@ class RichPath:
             - specific beats general
             - files beat directories
 
+        Args:
+            fs: the file system to expand globs on.
+
         Yields:
             ReducePaths, ordered by their net relative_priority.
             suitable for inclusion in order.
@@ -207,8 +401,11 @@ class RichPath:
             rel_prio = calc_raw_path_priority(raw)
             yield from sorted(
                 [
-                    ReducedPath(expanded, rel_prio, self.exclude)
-                    for expanded in iglob(raw, recursive=True)
+                    # "dir/**" also yields "dir/", which is just dir
+                    ReducedPath(
+                        normalize_path(expanded), rel_prio, self.exclude
+                    )
+                    for expanded in fs.iglob(raw)
                 ],
                 key=lambda reduced: reduced.priority,
             )
@@ -261,7 +458,7 @@ class RichPath:
 
     @staticmethod
     def reduce_many(
-        rps: Iterable[RichPath],
+        rps: Iterable[RichPath], fs: FileSystem = DISK
     ) -> Generator[ReducedPath, None, None]:
         """
         Reduces multiple RichPaths into a sequence of ReducedPaths, ordered
@@ -279,8 +476,10 @@ class RichPath:
         (i.e. 4 non-glob segments)
         """
 
+        from heapq import merge
+
         by_prio: Iterable[ReducedPath] = merge(
-            *(rp.iter_reduced() for rp in rps),
+            *(rp.iter_reduced(fs) for rp in rps),
             key=lambda reduced: reduced.priority,
         )
 
@@ -288,10 +487,20 @@ class RichPath:
             yield sorted(group, key=lambda reduced: reduced.rel_prio)[-1]
 
 
+def read_path_list(stream: TextIO) -> List[str]:
+    """
+    Reads a list of paths, separated by NULs if there are any (as produced by
+    `find -print0`), and by newlines otherwise. Empty entries are dropped.
+    """
+    data = stream.read()
+    sep = "\0" if "\0" in data else "\n"
+    return [path for path in data.split(sep) if path]
+
+
 def canonicalize_group_name(group: str) -> str:
     group = group.lower()
     if set(group) - ALLOWABLE_CHARS:
-        die("Illegal characters in group name.")
+        raise BackupError("Illegal characters in group name.")
     return group
 
 
@@ -300,21 +509,31 @@ def get_backup_fp(fp: Path) -> Path:
 
 
 def get_group_manifest_file(
-    group: str, need_exist=True, check_backup=True
+    group: str,
+    need_exist=True,
+    check_backup=True,
+    *,
+    config_dir: Optional[Path] = None,
+    restore_backup: Optional[bool] = None,
 ) -> Path:
     """
     Get the path of the file storing the backup manifest for the group.
 
     Arguments:
         group: group for which to get manifest file
-        need_exist: if True, dies if manifest does not exist.
-        check_backup: if we would die because of need_*s, check backup first.
-            If a backup file exists, prompt to restore.
+        need_exist: if True, raises if manifest does not exist.
+        check_backup: if we would raise because of need_*s, check backup
+            first. If a backup file exists, offer to restore it.
+        config_dir: the config directory, see ensure_config_dir.
+        restore_backup: whether to restore a found backup. If None, the user
+            is prompted.
     """
 
     group = canonicalize_group_name(group)
 
-    fp = CONFIG_DIR.joinpath(f"{group}.txt")
+    if config_dir is None:
+        config_dir = CONFIG_DIR
+    fp = config_dir.joinpath(f"{group}.txt")
     fp_bkp = get_backup_fp(fp)
 
     # conditions not met
@@ -325,12 +544,16 @@ def get_group_manifest_file(
                 + "was. Would you like to restore the backup file?"
             )
 
-            if click.confirm(msg, default=True):
+            if restore_backup is None:
+                restore_backup = click.confirm(msg, default=True)
+            if restore_backup:
+                from shutil import copy as fcopy
+
                 fcopy(fp_bkp.as_posix(), fp.as_posix())
                 return fp
 
         elif need_exist:
-            die(f'Group "{group}" does not exist.')
+            raise BackupError(f'Group "{group}" does not exist.')
 
     return fp
 
@@ -338,6 +561,9 @@ def get_group_manifest_file(
 def get_group_rps(
     group: str,
     need_exist=False,
+    *,
+    config_dir: Optional[Path] = None,
+    restore_backup: Optional[bool] = None,
 ) -> List[RichPath]:
     """
     Get the list of rich paths corresponding to a group. This is distinct from
@@ -346,6 +572,8 @@ def get_group_rps(
     Args:
         group: the name of the group to read
         need_exist: whether it is an error if the group does not exist.
+        config_dir: the config directory, see ensure_config_dir.
+        restore_backup: see get_group_manifest_file.
 
     Returns:
         A list of RichPath objects stored in the group. This is empty if the
@@ -353,7 +581,12 @@ def get_group_rps(
 
     """
 
-    fp = get_group_manifest_file(group, need_exist=need_exist)
+    fp = get_group_manifest_file(
+        group,
+        need_exist=need_exist,
+        config_dir=config_dir,
+        restore_backup=restore_backup,
+    )
 
     if not fp.exists():
         return []
@@ -362,46 +595,106 @@ def get_group_rps(
             return [RichPath.parse(line) for line in f]
 
 
-def commit_group_rps(group: str, rps: Iterable[RichPath]) -> None:
+def commit_group_rps(
+    group: str,
+    rps: Iterable[RichPath],
+    *,
+    existing: Iterable[str] = (),
+    config_dir: Optional[Path] = None,
+    compact: Optional[bool] = None,
+) -> None:
     """
     Atomically commit the passed rps as the new contents of the group file.
 
     Does NOT append or merge, that is the responsibility of the caller.
 
     Does not write empty files - empty rps is a noop.
+
+    Args:
+        group: the group to commit to.
+        rps: the new contents of the group.
+        existing: paths the caller has just checked exist, which are not
+            checked again.
+        config_dir: the config directory, see ensure_config_dir.
+        compact: whether to drop redundant rps, see compact_rps. Defaults
+            to the auto_compact setting of the [py9backup] section.
     """
+    import tempfile as tmp
+    from shutil import copy as fcopy
+
+    config_dir = ensure_config_dir(config_dir)
 
-    fp = get_group_manifest_file(group, need_exist=False, check_backup=False)
+    fp = get_group_manifest_file(
+        group, need_exist=False, check_backup=False, config_dir=config_dir
+    )
     fp_bkp = get_backup_fp(fp)
 
     # if the file already exists, back it up
     if fp.exists() and fp.stat().st_size > 0:
         fcopy(str(fp), str(fp_bkp))
 
-    with tmp.NamedTemporaryFile(mode="w") as tf:
-        for rp in sorted(set(rps)):
-            if rp.is_glob or rp.sticky or osp.exists(rp.str):
+    rps = sorted(set(rps))
+    existing = set(existing)
+    to_check = [
+        rp.str
+        for rp in rps
+        if not (rp.is_glob or rp.sticky or rp.str in existing)
+    ]
+    existing |= {
+        path
+        for path, exists in zip(to_check, parallel_map(osp.exists, to_check))
+        if exists
+    }
+    rps = [rp for rp in rps if rp.is_glob or rp.sticky or rp.str in existing]
+
+    if compact is None:
+        compact = load_settings(config_dir).getboolean(
+            "py9backup", "auto_compact", fallback=False
+        )
+    if compact:
+        rps = compact_rps(rps)
+
+    # write next to the manifest and rename over it, so that the manifest is
+    # never seen half-written
+    with tmp.NamedTemporaryFile(
+        mode="w", dir=fp.parent, prefix=f".{fp.name}.", delete=False
+    ) as tf:
+        try:
+            for rp in rps:
                 tf.write(str(rp) + "\n")
 
-        tf.flush()
-        fcopy(tf.name, str(fp))
+            tf.flush()
+            os.fsync(tf.fileno())
+            if fp.exists():
+                os.chmod(tf.name, fp.stat().st_mode & 0o777)
+        except BaseException:
+            os.unlink(tf.name)
+            raise
+
+    os.replace(tf.name, fp)
 
     # if a backup does not exist, initialize it to the fresh file contents
     if not fp_bkp.exists() and fp.stat().st_size > 0:
         fcopy(str(fp), str(fp_bkp))
 
 
-def gather_effective_files(rps: Iterable[RichPath]) -> List[str]:
+def gather_effective_files(
+    rps: Iterable[RichPath], fs: FileSystem = DISK
+) -> List[str]:
     """
     Resolves a collection of rich paths paths to a minimal collection
     of include-only paths.
+
+    Args:
+        rps: the rich paths to resolve.
+        fs: the file system to expand globs and list directories on.
     """
 
     # sort all paths by depth
     effective_by_depth: Dict[int, Set[str]] = defaultdict(set)
 
     rdp: ReducedPath
-    for rdp in RichPath.reduce_many(rps):
+    for rdp in RichPath.reduce_many(rps, fs):
 
         # exclusions force explicit expansion in each level above them
         if rdp.excl:
@@ -419,7 +712,8 @@ def gather_effective_files(rps: Iterable[RichPath]) -> List[str]:
                     # remove higher-level str in favour of fragments
                     effective_by_depth[dx].remove(candidate_prefix)
                     effective_by_depth[dx + 1] |= {
-                        str(x) for x in Path(candidate_prefix).iterdir()
+                        osp.join(candidate_prefix, child)
+                        for child in fs.listdir(candidate_prefix)
                     }
                     break
 
@@ -447,225 +741,3022 @@ def gather_effective_files(rps: Iterable[RichPath]) -> List[str]:
     return sorted(out)
 
 
-# # # COMMANDS SECTION
-
-
-@click.group()
-def main() -> None:
+def normalize_path(path: str) -> str:
     """
-    Tracks files to be backed up, on a per-group basis.
-
-    The first argument is always the group name, which can be an arbitrary well
-    behaving string which serves as an identifier for the collection of paths
-    added. This allows different backup flow for different files.
+    Strips trailing slashes, as left behind by some glob expansions.
     """
+    return path.rstrip("/") or "/"
 
 
-@main.command(name="add")
-@click.argument("group", nargs=1)
-@click.argument("paths", nargs=-1)
-@click.option(
-    "--allow-nx",
-    is_flag=True,
-    default=False,
-    help=(
-        "Allows nonexistent entries and persists them until explicit "
-        "deletion. Otherwise, nonexistent entries are dropped."
-    ),
-)
-@click.option(
-    "--exclude",
-    is_flag=True,
-    default=False,
-    help=(
-        "Excludes the file or str. Overrides more general inclusions. "
-        "Overriden by more specific inclusions."
-    ),
-)
-@click.option(
-    "--glob/--no-glob",
-    is_flag=True,
-    default=None,
-    help=(
-        "If true, the str will be interpreted as a glob. If false, it "
-        "will be interpreted literally. If unset, the str will be "
-        'treated as a glob iff it contains an unescaped "*".'
-    ),
-)
-def add_files(group: str, paths: Iterable[str], *, exclude, allow_nx, glob):
+def translate_glob(raw: str) -> str:
     """
-    Adds a str to be tracked under a group.
-    """
-    group = canonicalize_group_name(group)
-    rps = set(get_group_rps(group))
+    Translates an absolute glob to a regex matching the same paths that
+    `iglob(raw, recursive=True)` would produce, without touching the disk.
 
-    new_rps = set()
-    for path in paths:
+    Like glob, wildcards do not match names starting with a dot unless the
+    pattern segment does, and "**" matches any number of such names.
+    """
 
-        if glob is None:
-            glob = is_glob(path)
+    # matches one path segment that is not hidden
+    visible_segment = r"/(?!\.)[^/]+"
 
-        if not (allow_nx or osp.isfile(path) or osp.isdir(path) or glob):
-            echo(
-                f'Path "{path}" does not exist. Ignoring. '
-                "Pass --allow-nx to force persistent inclusion."
-            )
+    out = []
+    for segment in raw.strip("/").split("/"):
+        if segment == "":
+            continue
+        if segment == "**":
+            out.append(f"(?:{visible_segment})*")
             continue
 
-        new_rp = RichPath(path, exclude=exclude, sticky=allow_nx, is_glob=glob)
-        new_rps.add(new_rp)
+        out.append("/")
+        if not segment.startswith(".") and re.search(r"[*?\[]", segment):
+            out.append(r"(?!\.)")
+
+        ix = 0
+        while ix < len(segment):
+            char = segment[ix]
+            ix += 1
+            if char == "*":
+                out.append("[^/]*")
+            elif char == "?":
+                out.append("[^/]")
+            elif char == "[":
+                # same bracket rules as fnmatch: a leading "!" negates, a
+                # leading "]" is literal, and an unclosed bracket is literal
+                end = ix
+                if end < len(segment) and segment[end] == "!":
+                    end += 1
+                if end < len(segment) and segment[end] == "]":
+                    end += 1
+                end = segment.find("]", end)
+                if end < 0:
+                    out.append(r"\[")
+                    continue
+                chars = segment[ix:end].replace("\\", r"\\")
+                ix = end + 1
+                if chars.startswith("!"):
+                    chars = "^" + chars[1:]
+                elif chars.startswith("^"):
+                    chars = "\\" + chars
+                out.append(f"(?!/)[{chars}]")
+            else:
+                out.append(re.escape(char))
 
-    # order is important, we need to favour the new rps in hash conflicts
-    rps = new_rps | rps
-    commit_group_rps(group, rps)
+    return "".join(out)
 
 
-@main.command("show")
-@click.argument("group")
-@click.option(
-    "--full",
-    is_flag=True,
-    default=False,
-    help="show every included file explicitly",
-)
-def show_files(group: str, *, full) -> None:
+@dataclass(frozen=True)
+class GlobRule:
     """
-    Shows all tracked paths for group.
+    A glob RichPath compiled for matching single paths, see translate_glob.
     """
-    rps = get_group_rps(group, need_exist=True)
-    if not full:
-        for rp in rps:
-            echo(" " + str(rp))
-    else:
-        for fn in gather_effective_files(rps):
-            echo("\t" + fn)
 
+    regex: re.Pattern
+    # the leading non-glob segments, which any match starts with
+    prefix: str
+    rel_prio: int
+    excl: bool
 
-@main.command(name="del")
-@click.argument("group")
-@click.argument("regex")
-def del_files(group: str, regex: str):
-    """
-    Removes files from group by regex.
+    @classmethod
+    def compile(cls, rp: RichPath) -> GlobRule:
+        raw = rp.raw_entry
+        segments = raw.strip("/").split("/")
+        n_literal = next(
+            (ix for ix, seg in enumerate(segments) if re.search(r"[*?[]", seg)),
+            len(segments),
+        )
+        return cls(
+            regex=re.compile(translate_glob(raw)),
+            prefix="/" + "/".join(segments[:n_literal]),
+            rel_prio=calc_raw_path_priority(raw),
+            excl=rp.exclude,
+        )
 
-    Python's `re.match` is used, so the regexp should match from the
-    beginning of the str. Use ^.* or similar.
-    """
+    def matches(self, path: str) -> bool:
+        if not (
+            self.prefix == "/"
+            or path == self.prefix
+            or path.startswith(self.prefix + "/")
+        ):
+            return False
+        return self.regex.fullmatch("" if path == "/" else path) is not None
 
-    if regex == "." and click.confirm(
-        '"del ." will delete every file in the group. Did you intend to '
-        "delete the current directory instead?",
-        default=True,
-    ):
-        regex = os.getcwd()
-    elif regex == ".." and click.confirm(
-        '"del .." will likely delete every file in the group. Did you'
-        "intend to delete the current directory instead?",
-        default=True,
-    ):
-        regex = str(Path(os.getcwd()).parent)
 
-    regex.rstrip("/")
+class PathMatcher:
+    """
+    Decides whether single paths are included, given a set of ReducedPaths.
+
+    The state of a path is that of the nearest rule at or above it, which is
+    the same precedence gather_effective_files applies by splitting up
+    directories level by level.
+
+    Matchers built with PathMatcher.compile additionally hold glob rules,
+    matched against each ancestor instead of being expanded on disk. Where a
+    glob and another rule apply to the same path, the one with the higher
+    relative priority wins, as in RichPath.reduce_many. Globs are indexed by
+    their leading non-glob segments, so that only those rooted above a path
+    are tried on it. Call index_globs after changing globs.
+    """
 
-    path_reg = re.compile(regex)
-    rps = get_group_rps(group)
+    def __init__(
+        self, rdps: Iterable[ReducedPath], globs: Iterable[GlobRule] = ()
+    ) -> None:
+        # maps normalized paths to their exclude flag
+        self.rules: Dict[str, bool] = {
+            normalize_path(rdp.path): rdp.excl for rdp in rdps
+        }
+        # later globs win priority ties, like later rps in reduce_many
+        self.globs = list(globs)
+        self.index_globs()
+
+    def index_globs(self) -> None:
+        # maps glob prefixes to the positions of the globs in self.globs
+        self.glob_index: Dict[str, List[int]] = defaultdict(list)
+        for ix, glob in enumerate(self.globs):
+            self.glob_index[glob.prefix].append(ix)
+
+    def _globs_above(self, path: str) -> List[GlobRule]:
+        """
+        Finds the globs that can match path or its ancestors, which are
+        those rooted at or above it, in order.
+        """
+        ixs: List[int] = []
+        while True:
+            ixs.extend(self.glob_index.get(path, ()))
+            if path == "/":
+                break
+            path = osp.dirname(path)
+        return [self.globs[ix] for ix in sorted(ixs)]
 
-    keep_rps = [rp for rp in rps if not path_reg.search(str(rp))]
-    commit_group_rps(group, keep_rps)
+    @classmethod
+    def compile(cls, rps: Iterable[RichPath]) -> PathMatcher:
+        """
+        Builds a matcher for rich paths without expanding any globs, so that
+        membership can be queried in time proportional to a path's depth.
 
+        Args:
+            rps: the rich paths, in manifest order.
+        """
+        rps = list(rps)
+        return cls(
+            (
+                ReducedPath(rp.raw_entry, None, rp.exclude)
+                for rp in rps
+                if not rp.is_glob
+            ),
+            (GlobRule.compile(rp) for rp in rps if rp.is_glob),
+        )
 
-@main.command()
-@click.argument("group")
-@click.argument("commands", nargs=-1)
-@click.option(
-    "--no-xz",
-    default=False,
-    is_flag=True,
-    help="turn off compression",
-)
-@click.option(
-    "--compalgo",
-    default="gz",
-    help="compression algorithm to use",
-    type=Choice(["xz", "bz2", "gz"], case_sensitive=False),
-)
-@click.option("--name", default=None, help="name to use for the tarball")
-def pull(group, commands, *, no_xz, name, compalgo: str) -> None:
-    """
-    Pulls files into tarball, runs given commands on it.
+    def _rule_at(self, path: str, globs: List[GlobRule]) -> Optional[bool]:
+        excl = self.rules.get(path)
+        if not globs:
+            return excl
 
-    First, a tarball containing all of the files in the group is created
-    in a temporary directory. It is given a sensible default name, which
-    can be overriden with the --name option.
+        # a literal path's priority is its depth, see ReducedPath.rel_prio.
+        # globs only beat it with a strictly higher priority, hence the + 1,
+        # since the manifest sorts globs first. among globs, later ones win.
+        best_prio = -1
+        if excl is not None:
+            best_prio = path.strip("/").count("/") + 1
 
-    This action accepts any number of positional parameters, each of which
-    is interpreted as a shell command to run. Within these commands, the
-    string "{}" is expanded to the name of the newly-created tar file.
+        for glob in globs:
+            if glob.rel_prio >= best_prio and glob.matches(path):
+                excl, best_prio = glob.excl, glob.rel_prio
 
-    After the commands have been executed, the tarfile is deleted.
-    """
+        return excl
 
-    if name is None:
-        name = f"backup_{group}_{date.today().isoformat()}"
+    def governing_rule(self, path: str, strict=False) -> Optional[bool]:
+        """
+        Finds the rule governing a path.
 
-    tar_mode = "w" if no_xz else f"w:{compalgo}"
-    suf = "tar" if no_xz else f"tar.{compalgo}"
+        Args:
+            path: the absolute path to look up
+            strict: if True, ignore any rule for the path itself and only
+                consider its proper ancestors.
 
-    file_paths = gather_effective_files(get_group_rps(group, need_exist=True))
+        Returns:
+            the exclude flag of the nearest rule, or None if no rule applies.
+        """
+        path = normalize_path(path)
+        if strict:
+            if path == "/":
+                return None
+            path = osp.dirname(path)
+
+        # the globs rooted above an ancestor are among those above the path
+        globs = self._globs_above(path) if self.globs else []
+        while True:
+            excl = self._rule_at(path, globs)
+            if excl is not None:
+                return excl
+            if path == "/":
+                return None
+            path = osp.dirname(path)
+
+    def __contains__(self, path: str) -> bool:
+        return self.governing_rule(path) is False
+
+
+def gather_include_roots(
+    rps: Iterable[RichPath], fs: FileSystem = DISK
+) -> Tuple[List[str], PathMatcher]:
+    """
+    Resolves a collection of rich paths to coarse include roots.
 
-    if len(file_paths) == 0 and not click.confirm(
-        f"Group {group} is empty. Continue?", default=False
-    ):
-        return
+    Unlike gather_effective_files, included directories are never split up
+    around exclusions. Instead, the returned matcher should be used to prune
+    excluded paths when walking the roots, see iter_archive_paths.
 
-    temp_dir = tmp.mkdtemp()
-    tar_fn = osp.join(temp_dir, f"{name}.{suf}")
+    Args:
+        rps: the rich paths to resolve.
+        fs: the file system to expand globs on.
 
-    with tarfile.open(tar_fn, tar_mode) as tar:
-        for path in file_paths:
-            try:
-                tar.add(path.strip())
-            except FileNotFoundError:
-                echo(f"File {path} not found, skipping.", file=sys.stderr)
-            except PermissionError:
-                die(f"File {path} needs elevated permissions. Dying.")
+    Returns:
+        the sorted include roots, and the matcher for the rich paths.
+    """
 
-    if not commands:
-        settings = load_settings()
-        try:
-            commands = [settings["py9backup"]["default_pull_command"]]
-            click.echo(
-                "Running default pull commands:\n\t" + "\n\t".join(commands)
-            )
-        except KeyError:
-            commands = []
+    rdps = list(RichPath.reduce_many(rps, fs))
+    matcher = PathMatcher(rdps)
 
-    for com in commands:
-        com = re.sub(r"{}", tar_fn, com)
-        os.system(com)
+    # an include is only a root if it is included itself, which a glob can
+    # overrule, and not already covered by an include above it, i.e. it sits
+    # outside of any rule or under an exclusion
+    roots = {
+        normalize_path(rdp.path)
+        for rdp in rdps
+        if not rdp.excl
+        and normalize_path(rdp.path) in matcher
+        and matcher.governing_rule(rdp.path, strict=True) is not False
+    }
 
-    rmtree(temp_dir, ignore_errors=True)
+    return sorted(roots), matcher
 
 
-@main.command("list")
-def list_groups() -> None:
+def normalize_glob(raw: str) -> str:
     """
-    List known groups.
+    Collapses runs of "**" segments, which match the same paths as one.
     """
-    for path in sorted(Path(CONFIG_DIR).glob("*.txt")):
-        echo(path.stem)
+    return re.sub(r"(?<=/)\*\*(?:/\*\*)+(?=/|$)", "**", raw)
 
 
-@main.command()
-@click.argument("group")
-@click.option("--drop-backup", default=False, help="also forgets the backup")
-def forget(group: str, drop_backup: bool):
+def compact_rps(rps: Iterable[RichPath]) -> List[RichPath]:
     """
-    Deletes the registry file for a group. Unless that file itself is
-    backed up (as is recommended), this cannot be undone.
+    Drops the rich paths that make no difference to which paths are
+    included, according to PathMatcher, so that resolving is cheaper.
+
+    Dropped are, in this order:
+        - globs matching the same paths as a later glob, which wins all ties
+          with them.
+        - paths that get the same decision from the rules above them, deepest
+          first. Exclusions outside of any include are among these.
+        - globs whose every match gets the same decision from the rules
+          above it, as long as no rule deciding otherwise is at or below the
+          glob's leading non-glob segments. Other globs are kept, since
+          which paths they match is not known without listing directories.
+
+    Returns:
+        the kept rich paths, in manifest order.
     """
+    rps = sorted(set(rps))
+
+    def is_included(excl: Optional[bool]) -> bool:
+        return excl is False
+
+    # equivalent globs, keeping the last one
+    last_of: Dict[str, RichPath] = {
+        normalize_glob(rp.raw_entry): rp for rp in rps if rp.is_glob
+    }
+    rps = [
+        rp
+        for rp in rps
+        if not rp.is_glob or last_of[normalize_glob(rp.raw_entry)] is rp
+    ]
 
-    def render_lines(lines: List[str]) -> str:
+    matcher = PathMatcher.compile(rps)
+    dropped: Set[RichPath] = set()
+
+    literals = [rp for rp in rps if not rp.is_glob]
+    for rp in sorted(literals, key=lambda rp: -rp.raw_entry.count("/")):
+        path = normalize_path(rp.raw_entry)
+        excl = matcher.rules.pop(path)
+        if is_included(matcher.governing_rule(path)) == (not excl):
+            dropped.add(rp)
+        else:
+            matcher.rules[path] = excl
+
+    # matcher.globs is in the same order as the glob rps
+    globs = [rp for rp in rps if rp.is_glob]
+    for ix in reversed(range(len(globs))):
+        rule = matcher.globs.pop(ix)
+        matcher.index_globs()
+        redundant = is_included(matcher.governing_rule(rule.prefix)) == (
+            not rule.excl
+        )
+        redundant &= not any(
+            excl != rule.excl and is_fs_ancestor(rule.prefix, path)
+            for path, excl in matcher.rules.items()
+        )
+        redundant &= not any(
+            other.excl != rule.excl
+            and (
+                is_fs_ancestor(rule.prefix, other.prefix)
+                or is_fs_ancestor(other.prefix, rule.prefix)
+            )
+            for other in matcher.globs
+        )
+        if redundant:
+            dropped.add(globs[ix])
+        else:
+            matcher.globs.insert(ix, rule)
+            matcher.index_globs()
+
+    return [rp for rp in rps if rp not in dropped]
+
+
+def iter_archive_paths(
+    roots: Iterable[str],
+    matcher: Optional[PathMatcher] = None,
+    fs: FileSystem = DISK,
+) -> Generator[str, None, None]:
+    """
+    Walks the given roots in the order a recursive `tar.add` would.
+
+    Args:
+        roots: the paths to walk.
+        matcher: if given, excluded paths are skipped, and excluded
+            directories are not descended into.
+        fs: the file system to walk.
+    """
+
+    for root in roots:
+        yield root
+
+        if not fs.isdir(root) or fs.islink(root):
+            continue
+
+        try:
+            children = sorted(fs.listdir(root))
+        except FileNotFoundError:
+            continue
+        except PermissionError:
+            raise BackupError(
+                f"Directory {root} needs elevated permissions. Dying."
+            )
+
+        children = [osp.join(root, child) for child in children]
+        if matcher is not None:
+            children = [child for child in children if child in matcher]
+
+        yield from iter_archive_paths(children, matcher, fs)
+
+
+def parse_size(size: str) -> int:
+    """
+    Parses a byte count with an optional binary suffix, e.g. "512K" or "20M".
+    """
+    size = size.strip().upper().rstrip("B")
+    for exp, suffix in enumerate("KMGT", start=1):
+        if size.endswith(suffix):
+            return int(float(size[:-1]) * 1024**exp)
+    return int(size)
+
+
+def format_size(size: float) -> str:
+    """
+    Formats a byte count with a binary suffix, the inverse of parse_size.
+    """
+    for suffix in ["", "K", "M", "G"]:
+        if abs(size) < 1024:
+            return f"{size:.1f}{suffix}"
+        size /= 1024
+    return f"{size:.1f}T"
+
+
+class PullGovernor:
+    """
+    Limits the resources used by a pull, so that it can run next to latency
+    sensitive workloads.
+
+    Configured in the [governor] section of settings.ini:
+        enabled: if true, pulls are always governed.
+        read_limit: maximum read bandwidth, e.g. 20M (per second).
+        cpu_limit: maximum fraction of a core to use, reading and
+            compressing included, e.g. 0.5.
+        nice: niceness increment for the pulling process.
+        io_class: I/O scheduling class, "idle" or "best-effort".
+        io_level: I/O priority within the best-effort class, 0 to 7.
+        drop_cache: if true (the default), read files are dropped from the
+            page cache, so that they do not evict other workloads' pages.
+
+    Readers report the files they open and the data they read to the
+    governor, which sleeps as needed to stay within the limits.
+    """
+
+    SECTION = "governor"
+    IO_CLASSES = {"best-effort": 2, "idle": 3}
+    # sleeps shorter than this are deferred, to keep the syscall rate down
+    MIN_SLEEP = 0.01
+
+    def __init__(
+        self,
+        *,
+        read_limit: Optional[int] = None,
+        cpu_limit: Optional[float] = None,
+        nice: int = 0,
+        io_class: Optional[str] = None,
+        io_level: Optional[int] = None,
+        drop_cache: bool = True,
+    ) -> None:
+
+        if cpu_limit is not None and cpu_limit <= 0:
+            raise BackupError(
+                f"Invalid cpu_limit {cpu_limit}, must be positive."
+            )
+        if read_limit is not None and read_limit <= 0:
+            raise BackupError(
+                f"Invalid read_limit {read_limit}, must be positive."
+            )
+        if io_level is not None and not 0 <= io_level <= 7:
+            raise BackupError(
+                f"Invalid io_level {io_level}, must be between 0 and 7."
+            )
+        if io_class is not None and io_class not in self.IO_CLASSES:
+            raise BackupError(
+                f'Invalid io_class "{io_class}", must be one of '
+                + ", ".join(self.IO_CLASSES)
+            )
+
+        self.read_limit = read_limit
+        self.cpu_limit = cpu_limit
+        self.nice = nice
+        self.io_class = io_class
+        self.io_level = io_level
+        self.drop_cache = drop_cache
+
+        self.n_read = 0
+        self.start_wall = time.monotonic()
+        self.start_cpu = time.process_time()
+
+    @classmethod
+    def from_settings(cls, settings: ini.ConfigParser) -> PullGovernor:
+        if not settings.has_section(cls.SECTION):
+            return cls()
+
+        section = settings[cls.SECTION]
+        try:
+            return cls(
+                read_limit=(
+                    parse_size(section["read_limit"])
+                    if "read_limit" in section
+                    else None
+                ),
+                cpu_limit=section.getfloat("cpu_limit"),
+                nice=section.getint("nice", 0),
+                io_class=section.get("io_class"),
+                io_level=section.getint("io_level"),
+                drop_cache=section.getboolean("drop_cache", True),
+            )
+        except ValueError as e:
+            raise BackupError(f"Invalid [{cls.SECTION}] settings: {e}")
+
+    def apply_priorities(self) -> None:
+        """
+        Lowers the CPU and I/O priorities of the current process.
+        """
+        if self.nice:
+            os.nice(self.nice)
+
+        if self.io_class is not None:
+            import subprocess
+            from shutil import which
+
+            if which("ionice") is None:
+                echo(
+                    "ionice not found, not setting I/O priority.",
+                    file=sys.stderr,
+                )
+                return
+
+            args = ["ionice", "-c", str(self.IO_CLASSES[self.io_class])]
+            if self.io_level is not None and self.io_class == "best-effort":
+                args += ["-n", str(self.io_level)]
+            subprocess.run(args + ["-p", str(os.getpid())], check=False)
+
+    def advise_open(self, fd: int) -> None:
+        """
+        Hints that an opened file will be read once, sequentially.
+        """
+        if self.drop_cache and hasattr(os, "posix_fadvise"):
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_NOREUSE)
+
+    def account(self, fd: int, offset: int, n_read: int) -> None:
+        """
+        Accounts for a range of an open file having been read.
+        """
+        if self.drop_cache and hasattr(os, "posix_fadvise"):
+            os.posix_fadvise(fd, offset, n_read, os.POSIX_FADV_DONTNEED)
+        self.throttle(n_read)
+
+    def throttle(self, n_read: int) -> None:
+        """
+        Accounts for n_read bytes having been read, sleeping as long as needed
+        to stay within the bandwidth and CPU limits since the start.
+        """
+
+        self.n_read += n_read
+
+        # the earliest time, relative to the start, at which we are allowed
+        # to have done what we have done so far
+        target = 0.0
+        if self.read_limit is not None:
+            target = self.n_read / self.read_limit
+        if self.cpu_limit is not None:
+            cpu_used = time.process_time() - self.start_cpu
+            target = max(target, cpu_used / self.cpu_limit)
+
+        delay = target - (time.monotonic() - self.start_wall)
+        if delay >= self.MIN_SLEEP:
+            time.sleep(delay)
+
+
+class ArchiveSink:
+    """
+    A write-only file object compressing the tar stream written to it.
+
+    The output is a sequence of independently compressed segments, which
+    gzip, bzip2 and xz all decompress as if it were a single stream. Ending a
+    segment makes everything written so far durable and decodable on its own,
+    so that an interrupted archive can be truncated back to the end of its
+    last segment and appended to.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        compalgo: Optional[str],
+        *,
+        resume_at: Optional[Tuple[int, int]] = None,
+    ) -> None:
+        """
+        Args:
+            path: the archive file to write.
+            compalgo: one of "gz", "bz2", "xz", or None for no compression.
+            resume_at: the raw and tar offsets at the end of a previously
+                written segment to continue from. Anything in the file past
+                the raw offset is discarded.
+        """
+
+        self.name = path
+        self.compalgo = compalgo
+        self.compressor: Any = None
+        # cleared if the kernel refuses to copy for us
+        self.kernel_copy = True
+        # the size of the archive, once closed
+        self.raw_size = 0
+
+        if resume_at is None:
+            self.f = open(path, "wb")
+            self.pos = 0
+        else:
+            raw_offset, self.pos = resume_at
+            self.f = open(path, "r+b")
+            self.f.truncate(raw_offset)
+            self.f.seek(raw_offset)
+
+    def _new_compressor(self) -> Any:
+        if self.compalgo == "gz":
+            import zlib
+
+            # wbits=31 selects the gzip container
+            return zlib.compressobj(9, zlib.DEFLATED, 31)
+        elif self.compalgo == "bz2":
+            import bz2
+
+            return bz2.BZ2Compressor(9)
+        elif self.compalgo == "xz":
+            import lzma
+
+            return lzma.LZMACompressor(format=lzma.FORMAT_XZ)
+        else:
+            raise ValueError(f"Unknown compression {self.compalgo}")
+
+    def write(self, data: bytes) -> int:
+        self.pos += len(data)
+
+        if self.compalgo is None:
+            self.f.write(data)
+        else:
+            if self.compressor is None:
+                self.compressor = self._new_compressor()
+            self.f.write(self.compressor.compress(data))
+
+        return len(data)
+
+    def tell(self) -> int:
+        """
+        Returns the offset in the uncompressed tar stream.
+        """
+        return self.pos
+
+    def copy_from(self, fd: int, offset: int, count: int) -> int:
+        """
+        Writes up to count bytes of an open file, starting at offset.
+
+        Without compression the data is copied in the kernel, with
+        copy_file_range or sendfile, rather than through Python buffers.
+
+        Returns:
+            the number of bytes copied, which is only 0 at the end of the file.
+        """
+
+        if self.compalgo is None and self.kernel_copy:
+            self.f.flush()
+            raw_offset = self.f.tell()
+            try:
+                if hasattr(os, "copy_file_range"):
+                    n = os.copy_file_range(
+                        fd, self.f.fileno(), count, offset, raw_offset
+                    )
+                else:
+                    n = os.sendfile(self.f.fileno(), fd, offset, count)
+            except OSError as e:
+                # e.g. copying across file systems on old kernels
+                if e.errno not in KERNEL_COPY_ERRNOS:
+                    raise
+                self.kernel_copy = False
+            else:
+                self.f.seek(raw_offset + n)
+                self.pos += n
+                return n
+
+        data = os.pread(fd, count, offset)
+        self.write(data)
+        return len(data)
+
+    @property
+    def raw_offset(self) -> int:
+        if self.f.closed:
+            return self.raw_size
+        return self.f.tell()
+
+    def sync(self) -> None:
+        """
+        Restarts compression, so that the output from here on does not depend
+        on anything written before.
+        """
+        if self.compressor is None:
+            return
+
+        if self.compalgo == "gz":
+            import zlib
+
+            # keeps the gzip stream going, but with an empty dictionary
+            self.f.write(self.compressor.flush(zlib.Z_FULL_FLUSH))
+        else:
+            self.f.write(self.compressor.flush())
+            self.compressor = None
+
+    def end_segment(self) -> None:
+        """
+        Finishes the current compressed segment and syncs it to disk.
+        """
+        if self.compressor is not None:
+            self.f.write(self.compressor.flush())
+            self.compressor = None
+
+        self.f.flush()
+        os.fsync(self.f.fileno())
+
+    def close(self) -> None:
+        if not self.f.closed:
+            self.end_segment()
+            self.raw_size = self.f.tell()
+            self.f.close()
+
+    def __enter__(self) -> ArchiveSink:
+        return self
+
+    def __exit__(self, exc_type, *args) -> None:
+        # a failed archive is only good up to its last complete segment, so
+        # there is nothing worth finishing
+        if exc_type is None:
+            self.close()
+        else:
+            self.f.close()
+
+
+def find_data_segments(fd: int, size: int) -> List[Tuple[int, int]]:
+    """
+    Finds the (offset, length) segments of a file holding data, skipping holes.
+
+    Falls back to a single segment spanning the file if the platform or file
+    system cannot tell holes apart.
+    """
+
+    if not hasattr(os, "SEEK_DATA"):
+        return [(0, size)]
+
+    segments = []
+    offset = 0
+    try:
+        while offset < size:
+            data = os.lseek(fd, offset, os.SEEK_DATA)
+            hole = min(os.lseek(fd, data, os.SEEK_HOLE), size)
+            if hole > data:
+                segments.append((data, hole - data))
+            offset = hole
+    except OSError as e:
+        # ENXIO: there is no more data past offset
+        if e.errno != errno.ENXIO:
+            return [(0, size)]
+
+    return segments
+
+
+def make_sparse_member(
+    tarinfo: tarfile.TarInfo, segments: List[Tuple[int, int]]
+) -> bytes:
+    """
+    Turns tarinfo into a PAX 1.0 sparse member holding only the segments.
+
+    Returns:
+        the sparse map, to be written before the segment data.
+    """
+    import tarfile
+
+    # GNU tar wants the map to end at the end of the file
+    if not segments or sum(segments[-1]) < tarinfo.size:
+        segments = segments + [(tarinfo.size, 0)]
+
+    sparse_map = "".join(
+        f"{offset}\n{length}\n" for offset, length in segments
+    ).encode()
+    sparse_map = f"{len(segments)}\n".encode() + sparse_map
+    sparse_map += tarfile.NUL * (-len(sparse_map) % tarfile.BLOCKSIZE)
+
+    real_name = tarinfo.name
+    parent, base = osp.split(real_name)
+    tarinfo.name = osp.join(parent, "GNUSparseFile.0", base)
+
+    tarinfo.pax_headers = {
+        # a long placeholder name ends up in a "path" record, which readers
+        # apply in order, so it has to come before the real name
+        "path": tarinfo.name,
+        "GNU.sparse.major": "1",
+        "GNU.sparse.minor": "0",
+        "GNU.sparse.name": real_name,
+        "GNU.sparse.realsize": str(tarinfo.size),
+    }
+    tarinfo.size = len(sparse_map) + sum(length for _, length in segments)
+
+    return sparse_map
+
+
+def is_sync_point(path: str) -> bool:
+    """
+    Decides whether an rsyncable archive restarts compression before path.
+
+    This depends on nothing but the path, so that the compressed output
+    realigns after any change to the archived files, which is what lets
+    delta-transfer tools get away with sending only the changed parts. Large
+    members additionally restart every RSYNC_BLOCK bytes, see
+    add_archive_member.
+    """
+    import zlib
+
+    return (
+        zlib.crc32(path.encode(errors="surrogateescape"))
+        % RSYNC_MEMBER_INTERVAL
+        == 0
+    )
+
+
+def hash_file(path: str, governor: Optional[PullGovernor] = None) -> str:
+    """
+    Returns:
+        the hex SHA-256 of the file's contents.
+    """
+    import hashlib
+
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        fd = f.fileno()
+        if governor is not None:
+            governor.advise_open(fd)
+        offset = 0
+        for chunk in iter(lambda: f.read(COPY_CHUNK), b""):
+            digest.update(chunk)
+            if governor is not None:
+                governor.account(fd, offset, len(chunk))
+            offset += len(chunk)
+    return digest.hexdigest()
+
+
+class Duplicates:
+    """
+    Files with identical contents among the paths of a pull, so that all but
+    the first of them can be archived as hardlinks to it.
+
+    Only files of equal size are hashed. Since files can change between
+    being hashed and being archived, a duplicate is only linked if both it
+    and its original are still the inode they were hashed as, with the same
+    size and nanosecond mtime and ctime, when archived, see link_target.
+    """
+
+    def __init__(self) -> None:
+        # maps each duplicate to the first path with the same contents
+        self.originals: Dict[str, str] = {}
+        # the content hashes of the hashed files
+        self.hashes: Dict[str, str] = {}
+        # the stat_stamp of the hashed files when they were stat'ed for hashing
+        self.stamps: Dict[str, Tuple[int, int, int, int]] = {}
+        # hashed files archived in full, unchanged since they were hashed,
+        # see add_archive_member
+        self.archived: Set[str] = set()
+
+    @classmethod
+    def find(
+        cls,
+        paths: List[str],
+        governor: Optional[PullGovernor] = None,
+        stats: Optional[List[Optional[os.stat_result]]] = None,
+    ) -> Duplicates:
+        """
+        Args:
+            paths: the paths to archive, in the order they will be archived.
+            governor: the governor to hash files under, if any. Files are
+                hashed in parallel unless governed.
+            stats: the paths' lstat results, if already known, see
+                lstat_paths.
+        """
+        import stat
+
+        def hash_or_none(path: str) -> Optional[str]:
+            try:
+                return hash_file(path, governor)
+            except OSError:
+                return None
+
+        if stats is None:
+            stats = lstat_paths(paths)
+        by_size: Dict[int, List[Tuple[str, os.stat_result]]] = defaultdict(list)
+        for path, st in zip(paths, stats):
+            if st is not None and stat.S_ISREG(st.st_mode) and st.st_size > 0:
+                by_size[st.st_size].append((path, st))
+
+        candidates = [
+            candidate
+            for same_size in by_size.values()
+            if len(same_size) > 1
+            for candidate in same_size
+        ]
+        to_hash = [path for path, _ in candidates]
+        if governor is None:
+            digests = parallel_map(hash_or_none, to_hash)
+        else:
+            digests = [hash_or_none(path) for path in to_hash]
+
+        out = cls()
+        # candidates of each size are in archive order, so the first path
+        # seen with some contents is archived first
+        first: Dict[Tuple[int, str], str] = {}
+        for (path, st), digest in zip(candidates, digests):
+            if digest is None:
+                continue
+            out.hashes[path] = digest
+            out.stamps[path] = cls.stat_stamp(st)
+            key = (st.st_size, digest)
+            if key in first:
+                out.originals[path] = first[key]
+            else:
+                first[key] = path
+
+        return out
+
+    @staticmethod
+    def stat_stamp(st: os.stat_result) -> Tuple[int, int, int, int]:
+        # the ctime also changes on writes that restore the mtime
+        return (st.st_ino, st.st_size, st.st_mtime_ns, st.st_ctime_ns)
+
+    def is_unchanged(
+        self, path: str, st: Optional[os.stat_result] = None
+    ) -> bool:
+        """
+        Checks that a hashed file has not changed since, given its current
+        stat, which is taken afresh if not given.
+        """
+        if path not in self.stamps:
+            return False
+        if st is None:
+            try:
+                st = os.lstat(path)
+            except OSError:
+                return False
+        return self.stamps[path] == self.stat_stamp(st)
+
+    def link_target(self, path: str) -> Optional[str]:
+        """
+        Returns:
+            the original to archive the file as a hardlink to, if any.
+        """
+        original = self.originals.get(path)
+        if original in self.archived and self.is_unchanged(path):
+            return original
+        return None
+
+
+def write_member_header(tar: tarfile.TarFile, tarinfo: tarfile.TarInfo) -> None:
+    """
+    Writes just the header of a member, whose data the caller writes itself.
+
+    TarFile.addfile refuses this for regular files since Python 3.13.
+    """
+    buf = tarinfo.tobuf(tar.format, tar.encoding, tar.errors)
+    tar.fileobj.write(buf)
+    tar.offset += len(buf)
+    tar.members.append(tarinfo)
+
+
+def add_archive_member(
+    tar: tarfile.TarFile,
+    path: str,
+    governor: Optional[PullGovernor] = None,
+    *,
+    rsyncable: bool = False,
+    duplicates: Optional[Duplicates] = None,
+) -> Optional[tarfile.TarInfo]:
+    """
+    Adds a single path to an archive written to an ArchiveSink, without
+    recursing into directories.
+
+    Holes in sparse files are left out of the archive, using a PAX sparse
+    member. File contents are copied in the kernel where the sink allows it,
+    and read under the governor, if one is given.
+
+    If rsyncable, the header is stripped of sub-second times, and compression
+    restarts every RSYNC_BLOCK bytes of file data.
+
+    If duplicates are given, files duplicating an already archived file are
+    added as hardlinks to it, which tar extracts as usual.
+
+    Returns:
+        the header of the added member, or None if the file type is not
+        supported. For files added as hardlinks, this is the header the file
+        would have had otherwise.
+    """
+    import tarfile
+    from copy import copy
+
+    tarinfo = tar.gettarinfo(path)
+    # unsupported file types, e.g. sockets, are skipped like tar.add does
+    if tarinfo is None:
+        return None
+
+    if rsyncable:
+        # fractional mtimes would add a PAX header to every member
+        tarinfo.mtime = int(tarinfo.mtime)
+
+    if not tarinfo.isreg():
+        tar.addfile(tarinfo)
+        return tarinfo
+
+    if duplicates is not None:
+        original = duplicates.link_target(path)
+        if original is not None:
+            link = copy(tarinfo)
+            link.type = tarfile.LNKTYPE
+            # the member name of the original, as gettarinfo makes it
+            link.linkname = original.lstrip("/")
+            link.size = 0
+            tar.addfile(link)
+            return tarinfo
+
+    sink: ArchiveSink = tar.fileobj  # type: ignore
+
+    with open(path, "rb") as f:
+        fd = f.fileno()
+        if governor is not None:
+            governor.advise_open(fd)
+
+        st = os.fstat(fd)
+        segments = [(0, tarinfo.size)]
+        sparse_map = b""
+        # only files with fewer blocks than their size can have holes, but
+        # so do compressed files and files with inline data, which have none
+        if st.st_blocks * 512 < tarinfo.size:
+            data_segments = find_data_segments(fd, tarinfo.size)
+            if sum(length for _, length in data_segments) < tarinfo.size:
+                segments = data_segments
+                sparse_map = make_sparse_member(tarinfo, segments)
+
+        write_member_header(tar, tarinfo)
+        sink.write(sparse_map)
+
+        for offset, length in segments:
+            done = 0
+            while done < length:
+                n = sink.copy_from(
+                    fd, offset + done, min(COPY_CHUNK, length - done)
+                )
+                if n == 0:
+                    break
+                if governor is not None:
+                    governor.account(fd, offset + done, n)
+                done += n
+                if rsyncable and (offset + done) % RSYNC_BLOCK == 0:
+                    sink.sync()
+
+            # keep the archive consistent if the file shrank under us
+            if done < length:
+                echo(f"File {path} shrank, zero-padding.", file=sys.stderr)
+                sink.write(tarfile.NUL * (length - done))
+
+        # others may only be linked to the file if what was archived is what
+        # was hashed, so it is checked once its contents are read
+        is_original = duplicates is not None and duplicates.is_unchanged(
+            path, os.fstat(fd)
+        )
+
+    blocks, remainder = divmod(tarinfo.size, tarfile.BLOCKSIZE)
+    if remainder > 0:
+        sink.write(tarfile.NUL * (tarfile.BLOCKSIZE - remainder))
+        blocks += 1
+    tar.offset += blocks * tarfile.BLOCKSIZE
+
+    if is_original:
+        duplicates.archived.add(path)
+
+    return tarinfo
+
+
+class PullProgress:
+    """
+    Reports the progress of a pull on stderr, either as a bar redrawn in
+    place or as JSON lines, at most every PROGRESS_INTERVAL seconds.
+
+    Reported are the files and bytes archived, average files and bytes read
+    and written per second, the compression ratio so far, and the time left
+    given the average read rate. Since compressors buffer their output, the
+    bytes written lag behind until the archive is closed.
+    """
+
+    MODES = ["bar", "json"]
+    BAR_WIDTH = 20
+
+    def __init__(
+        self, sizes: List[int], mode: str, stream: Optional[TextIO] = None
+    ) -> None:
+        """
+        Args:
+            sizes: the sizes of the files to archive, in archive order, and
+                0 for anything else.
+            mode: "bar" or "json".
+            stream: where to report to, stderr by default.
+        """
+        if mode not in self.MODES:
+            raise BackupError(f'Invalid progress mode "{mode}".')
+
+        self.sizes = sizes
+        self.total_bytes = sum(sizes)
+        self.mode = mode
+        self.stream = stream if stream is not None else sys.stderr
+
+        self.n_done = 0
+        self.bytes_done = 0
+        # the state at start, so that rates leave out resumed work
+        self.start_time = time.monotonic()
+        self.start_bytes = 0
+        self.start_files = 0
+        self.start_written = 0
+        self.next_report = self.start_time + PROGRESS_INTERVAL
+
+    def _advance(self, n_done: int) -> None:
+        # this runs once per archived file, so it is kept minimal
+        self.bytes_done += sum(self.sizes[self.n_done : n_done])
+        self.n_done = n_done
+
+    def start(self, n_done: int, sink: ArchiveSink) -> None:
+        """
+        Starts timing, with n_done paths already in the archive.
+        """
+        self._advance(n_done)
+        self.start_time = time.monotonic()
+        self.start_files = n_done
+        self.start_bytes = self.bytes_done
+        self.start_written = sink.raw_offset
+        self.next_report = self.start_time + PROGRESS_INTERVAL
+
+    def update(self, n_done: int, sink: ArchiveSink) -> None:
+        """
+        Records that the first n_done paths are in the archive, and reports
+        if it is time to.
+        """
+        self._advance(n_done)
+        now = time.monotonic()
+        if now >= self.next_report:
+            self.next_report = now + PROGRESS_INTERVAL
+            self.report(sink, now)
+
+    def report(
+        self, sink: ArchiveSink, now: Optional[float] = None, done=False
+    ) -> None:
+        """
+        Reports now. The last report should pass done, ending the bar.
+        """
+        if now is None:
+            now = time.monotonic()
+        elapsed = max(now - self.start_time, 1e-6)
+        written = sink.raw_offset
+
+        files_rate = (self.n_done - self.start_files) / elapsed
+        read_rate = (self.bytes_done - self.start_bytes) / elapsed
+        write_rate = (written - self.start_written) / elapsed
+        ratio = sink.tell() / written if written else None
+
+        eta: Optional[float] = None
+        if done:
+            eta = 0.0
+        elif self.total_bytes and read_rate > 0:
+            eta = (self.total_bytes - self.bytes_done) / read_rate
+        elif files_rate > 0:
+            eta = (len(self.sizes) - self.n_done) / files_rate
+
+        if self.mode == "json":
+            import json
+
+            line = json.dumps(
+                {
+                    "files": self.n_done,
+                    "total_files": len(self.sizes),
+                    "bytes_read": self.bytes_done,
+                    "total_bytes": self.total_bytes,
+                    "bytes_written": written,
+                    "files_per_s": round(files_rate, 1),
+                    "read_bytes_per_s": round(read_rate),
+                    "write_bytes_per_s": round(write_rate),
+                    "ratio": round(ratio, 3) if ratio is not None else None,
+                    "elapsed_s": round(elapsed, 1),
+                    "eta_s": round(eta, 1) if eta is not None else None,
+                    "done": done,
+                }
+            )
+            self.stream.write(line + "\n")
+        else:
+            if self.total_bytes:
+                frac = self.bytes_done / self.total_bytes
+            elif self.sizes:
+                frac = self.n_done / len(self.sizes)
+            else:
+                frac = 1.0
+            filled = int(frac * self.BAR_WIDTH)
+
+            eta_str = "-:--:--"
+            if eta is not None:
+                minutes, seconds = divmod(int(eta), 60)
+                eta_str = f"{minutes // 60}:{minutes % 60:02}:{seconds:02}"
+            ratio_str = f"{ratio:.2f}" if ratio is not None else "-"
+            self.stream.write(
+                f"\r[{'#' * filled}{'-' * (self.BAR_WIDTH - filled)}] "
+                f"{frac:4.0%} {self.n_done}/{len(self.sizes)} files "
+                f"{files_rate:.0f} files/s, "
+                f"read {format_size(read_rate)}/s, "
+                f"wrote {format_size(write_rate)}/s, "
+                f"ratio {ratio_str}, ETA {eta_str}\033[K"
+                + ("\n" if done else "")
+            )
+        self.stream.flush()
+
+
+@dataclass
+class PullCheckpoint:
+    """
+    The progress of a pull, kept under CONFIG_DIR so that an interrupted pull
+    can be picked up again with pull --resume. The partial archive is kept
+    there as well, since temporary directories do not survive reboots.
+
+    Pulls of a group hold its lock, see PullCheckpoint.lock, from before
+    looking at the checkpoint until they are done with the archive, so that
+    a running pull is never mistaken for an interrupted one.
+    """
+
+    group: str
+    tar_fn: str
+    compalgo: Optional[str]
+    # identifies the resolved group contents the pull was started with
+    digest: str
+    # the number of walked paths that are safely in the archive, and the last
+    # of them, to sanity check the walk against when resuming
+    n_done: int = 0
+    last_path: Optional[str] = None
+    # offsets at the end of the last complete segment, see ArchiveSink
+    raw_offset: int = 0
+    tar_offset: int = 0
+    # the archive is finished, only the pull commands remain to be run
+    complete: bool = False
+    # the id of the archive in the catalog, if it is being cataloged
+    archive_id: Optional[int] = None
+    # where the checkpoint is kept, see ensure_config_dir. not saved.
+    config_dir: Optional[Path] = field(default=None, repr=False, compare=False)
+    # the descriptor holding the group's lock, see lock. not saved.
+    lock_fd: Optional[int] = field(default=None, repr=False, compare=False)
+
+    @staticmethod
+    def get_fp(group: str, config_dir: Optional[Path] = None) -> Path:
+        if config_dir is None:
+            config_dir = CONFIG_DIR
+        return config_dir.joinpath(f".{group}.pull.json")
+
+    @staticmethod
+    def get_spool_dir(group: str, config_dir: Optional[Path] = None) -> Path:
+        """
+        Returns the directory the partial archive of the group is kept in.
+        """
+        if config_dir is None:
+            config_dir = CONFIG_DIR
+        return config_dir.joinpath(f".{group}.pull.d")
+
+    @staticmethod
+    def lock(group: str, config_dir: Optional[Path] = None) -> int:
+        """
+        Takes the group's pull lock, which is released when the returned
+        descriptor is closed, or the process exits.
+
+        Raises:
+            BackupError: if another pull of the group holds the lock.
+        """
+        import fcntl
+
+        config_dir = ensure_config_dir(config_dir)
+        fd = os.open(
+            config_dir.joinpath(f".{group}.pull.lock"),
+            os.O_RDWR | os.O_CREAT,
+            0o600,
+        )
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            raise BackupError(f"A pull of {group} is already running.")
+        return fd
+
+    @classmethod
+    def load(
+        cls, group: str, config_dir: Optional[Path] = None
+    ) -> Optional[PullCheckpoint]:
+        import json
+
+        fp = cls.get_fp(group, config_dir)
+        if not fp.exists():
+            return None
+
+        try:
+            with fp.open("r") as f:
+                return cls(**json.load(f), config_dir=config_dir)
+        except (ValueError, TypeError):
+            echo(f"Ignoring corrupt checkpoint {fp}.", file=sys.stderr)
+            return None
+
+    def save(self) -> None:
+        import json
+        from dataclasses import asdict
+
+        fp = self.get_fp(self.group, self.config_dir)
+        state = asdict(self)
+        del state["config_dir"], state["lock_fd"]
+        tmp_fp = fp.with_name(fp.name + ".tmp")
+        with tmp_fp.open("w") as f:
+            json.dump(state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_fp, fp)
+
+    def discard(self) -> None:
+        """
+        Deletes the checkpoint and the partial archive it refers to, and
+        releases the group's lock, if held.
+        """
+        from shutil import rmtree
+
+        rmtree(osp.dirname(self.tar_fn), ignore_errors=True)
+        self.get_fp(self.group, self.config_dir).unlink(missing_ok=True)
+        self.release()
+
+    def release(self) -> None:
+        """
+        Releases the group's lock, if held, keeping the checkpoint.
+        """
+        if self.lock_fd is not None:
+            os.close(self.lock_fd)
+            self.lock_fd = None
+
+
+def write_archive(
+    group: str,
+    paths: Iterable[str],
+    *,
+    tar_name: str,
+    compalgo: Optional[str],
+    digest: str,
+    resume: bool,
+    governor: Optional[PullGovernor] = None,
+    rsyncable: bool = False,
+    catalog: Optional[Catalog] = None,
+    config_dir: Optional[Path] = None,
+    duplicates: Optional[Duplicates] = None,
+    progress: Optional[PullProgress] = None,
+) -> PullCheckpoint:
+    """
+    Archives the given paths into the group's spool directory, checkpointing
+    as it goes. The caller has to hold the group's lock, see
+    PullCheckpoint.lock.
+
+    Args:
+        group: the group being pulled.
+        paths: the paths to archive, as walked by iter_archive_paths.
+        tar_name: the file name of the archive.
+        compalgo: the compression to use, or None.
+        digest: identifies the resolved group, to check resumption against.
+        resume: whether to resume the group's interrupted pull, if possible.
+        governor: the governor to read files under, if any.
+        rsyncable: make the archive deterministic and rsync-friendly, see
+            is_sync_point.
+        catalog: the catalog to record the archived files in, if any. Files
+            are recorded at each checkpoint, so that resumed pulls record
+            each file once.
+        config_dir: the config directory to keep the checkpoint in, see
+            ensure_config_dir.
+        duplicates: the duplicates among the paths, to archive as
+            hardlinks. Files archived before resuming are not linked to.
+        progress: where to report the progress of archiving, if anywhere.
+
+    Returns:
+        the checkpoint of the finished archive, see PullCheckpoint.discard.
+    """
+    import tarfile
+    from shutil import rmtree
+
+    ckpt = PullCheckpoint.load(group, config_dir)
+    if ckpt is not None:
+        if not resume:
+            echo("Discarding interrupted pull.", file=sys.stderr)
+        elif not osp.exists(ckpt.tar_fn):
+            echo(
+                "The partial archive of the interrupted pull is gone, "
+                "starting over.",
+                file=sys.stderr,
+            )
+        elif ckpt.digest != digest:
+            echo(
+                "The group changed since the interrupted pull, starting over.",
+                file=sys.stderr,
+            )
+        else:
+            resume = True
+        if not resume:
+            if catalog is not None and ckpt.archive_id is not None:
+                catalog.drop_archive(ckpt.archive_id)
+            ckpt.discard()
+            ckpt = None
+    elif resume:
+        echo("No interrupted pull to resume, starting over.", file=sys.stderr)
+
+    if ckpt is None:
+        # anything left over is from a pull whose checkpoint was lost
+        spool_dir = PullCheckpoint.get_spool_dir(group, config_dir)
+        rmtree(spool_dir, ignore_errors=True)
+        spool_dir.mkdir(parents=True)
+        ckpt = PullCheckpoint(
+            group=group,
+            tar_fn=str(spool_dir.joinpath(tar_name)),
+            compalgo=compalgo,
+            digest=digest,
+            config_dir=ensure_config_dir(config_dir),
+        )
+        if catalog is not None:
+            ckpt.archive_id = catalog.add_archive(group, tar_name)
+        ckpt.save()
+        sink = ArchiveSink(ckpt.tar_fn, ckpt.compalgo)
+    elif not ckpt.complete:
+        echo(f"Resuming after {ckpt.last_path}.", file=sys.stderr)
+        sink = ArchiveSink(
+            ckpt.tar_fn,
+            ckpt.compalgo,
+            resume_at=(ckpt.raw_offset, ckpt.tar_offset),
+        )
+
+    if not ckpt.complete:
+        # cataloged files not yet covered by a checkpoint
+        pending: List[Tuple[str, tarfile.TarInfo]] = []
+
+        def record_pending() -> None:
+            if catalog is not None and ckpt.archive_id is not None:
+                catalog.add_members(
+                    ckpt.archive_id,
+                    pending,
+                    duplicates.hashes if duplicates is not None else None,
+                )
+            pending.clear()
+
+        with sink, tarfile.open(fileobj=sink, mode="w") as tar:
+            if progress is not None:
+                progress.start(ckpt.n_done, sink)
+
+            prev_path: Optional[str] = None
+            for ix, path in enumerate(paths):
+
+                if ix < ckpt.n_done:
+                    if ix == ckpt.n_done - 1 and path != ckpt.last_path:
+                        raise BackupError(
+                            "The files in the group changed since the "
+                            "interrupted pull, cannot resume. Pull again "
+                            "without --resume."
+                        )
+                    prev_path = path
+                    continue
+
+                # rsyncable archives only restart compression at sync points,
+                # so checkpoints have to wait for one
+                sync = rsyncable and is_sync_point(path)
+                due = sink.tell() - ckpt.tar_offset >= CHECKPOINT_BYTES
+                if due and (sync or not rsyncable):
+                    sink.end_segment()
+                    record_pending()
+                    ckpt.n_done = ix
+                    ckpt.last_path = prev_path
+                    ckpt.raw_offset = sink.raw_offset
+                    ckpt.tar_offset = sink.tell()
+                    ckpt.save()
+                elif sync:
+                    sink.sync()
+
+                try:
+                    tarinfo = add_archive_member(
+                        tar,
+                        path,
+                        governor,
+                        rsyncable=rsyncable,
+                        duplicates=duplicates,
+                    )
+                    if tarinfo is not None:
+                        pending.append((path, tarinfo))
+                except FileNotFoundError:
+                    echo(f"File {path} not found, skipping.", file=sys.stderr)
+                except PermissionError:
+                    raise BackupError(
+                        f"File {path} needs elevated permissions. Dying."
+                    )
+
+                prev_path = path
+                if progress is not None:
+                    progress.update(ix + 1, sink)
+
+        # reported once closed, so that all compressed output is counted
+        if progress is not None:
+            progress.report(sink, done=True)
+
+        record_pending()
+        if catalog is not None and ckpt.archive_id is not None:
+            catalog.finish_archive(ckpt.archive_id)
+        ckpt.complete = True
+        ckpt.save()
+
+    return ckpt
+
+
+def copy_file(
+    src: str,
+    dst: str,
+    governor: Optional[PullGovernor] = None,
+    keep_owner: bool = False,
+) -> int:
+    """
+    Copies a file's contents, in the kernel where possible, and metadata.
+    The owner is only copied if keep_owner, which needs root.
+
+    Returns:
+        the number of bytes copied.
+    """
+    from shutil import copyfileobj, copystat
+
+    n_copied = 0
+    with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+        src_fd, dst_fd = fsrc.fileno(), fdst.fileno()
+        if governor is not None:
+            governor.advise_open(src_fd)
+
+        try:
+            while True:
+                n = os.copy_file_range(src_fd, dst_fd, COPY_CHUNK)
+                if n == 0:
+                    break
+                if governor is not None:
+                    governor.account(src_fd, n_copied, n)
+                n_copied += n
+        except (OSError, AttributeError) as e:
+            if isinstance(e, OSError) and e.errno not in KERNEL_COPY_ERRNOS:
+                raise
+            fsrc.seek(n_copied)
+            fdst.seek(n_copied)
+            copyfileobj(fsrc, fdst, COPY_CHUNK)
+            n_copied = fdst.tell()
+
+    if keep_owner:
+        st = os.lstat(src)
+        os.chown(dst, st.st_uid, st.st_gid, follow_symlinks=False)
+    copystat(src, dst, follow_symlinks=False)
+    return n_copied
+
+
+def get_mirrors_fp(group: str, config_dir: Optional[Path] = None) -> Path:
+    """
+    Returns the file recording the group's latest snapshot in each mirror
+    directory, as a JSON object.
+    """
+    if config_dir is None:
+        config_dir = CONFIG_DIR
+    return config_dir.joinpath(f".{group}.mirrors.json")
+
+
+def find_link_dest(
+    group: str, mirror_dir: str, config_dir: Optional[Path] = None
+) -> Optional[str]:
+    """
+    Finds the group's latest complete snapshot in mirror_dir, which other
+    groups may share. Snapshots are recorded when made, see
+    make_mirror_snapshot. Failing that, the latest snapshot with the default
+    name of the group's snapshots is used.
+    """
+    import json
+
+    try:
+        with get_mirrors_fp(group, config_dir).open("r") as f:
+            name = json.load(f).get(osp.realpath(mirror_dir))
+    except (FileNotFoundError, ValueError, AttributeError):
+        name = None
+
+    if name is not None:
+        path = osp.join(mirror_dir, name)
+        if osp.isdir(path) and not osp.islink(path):
+            return path
+
+    default_name = re.compile(rf"backup_{group}_\d{{4}}-\d\d-\d\d")
+    snapshots = [
+        entry
+        for entry in os.scandir(mirror_dir)
+        if entry.is_dir(follow_symlinks=False)
+        and default_name.fullmatch(entry.name)
+    ]
+    if not snapshots:
+        return None
+    return max(snapshots, key=lambda e: e.stat().st_mtime_ns).path
+
+
+def record_snapshot(
+    group: str, mirror_dir: str, name: str, config_dir: Optional[Path] = None
+) -> None:
+    """
+    Records name as the group's latest snapshot in mirror_dir.
+    """
+    import json
+
+    fp = get_mirrors_fp(group, ensure_config_dir(config_dir))
+    try:
+        with fp.open("r") as f:
+            latest = json.load(f)
+        if not isinstance(latest, dict):
+            latest = {}
+    except (FileNotFoundError, ValueError):
+        latest = {}
+    latest[osp.realpath(mirror_dir)] = name
+
+    tmp_fp = fp.with_name(fp.name + ".tmp")
+    with tmp_fp.open("w") as f:
+        json.dump(latest, f)
+    os.replace(tmp_fp, fp)
+
+
+def make_mirror_snapshot(
+    mirror_dir: str,
+    name: str,
+    paths: Iterable[str],
+    governor: Optional[PullGovernor] = None,
+    *,
+    group: str,
+    config_dir: Optional[Path] = None,
+) -> str:
+    """
+    Copies the given paths into a new snapshot directory, rsync --link-dest
+    style.
+
+    Regular files whose size, mtime and mode match the same file in the
+    group's latest snapshot in mirror_dir, see find_link_dest, are
+    hardlinked to it instead of copied, so each snapshot only costs the
+    changed files. As root, owners are kept, and have to match as well.
+    Files are copied by a thread pool. The snapshot is built under a
+    ".partial" name and only renamed into place when complete.
+
+    Args:
+        mirror_dir: the directory holding the snapshots.
+        name: the name of the new snapshot.
+        paths: the paths to mirror, as walked by iter_archive_paths.
+        governor: the governor to read files under, if any.
+        group: the group being mirrored.
+        config_dir: the config directory to record the snapshot in, see
+            ensure_config_dir.
+
+    Returns:
+        the path of the new snapshot.
+    """
+    import stat
+    from shutil import copystat, rmtree
+
+    snapshot_dir = osp.join(mirror_dir, name)
+    partial_dir = snapshot_dir + ".partial"
+    if osp.lexists(snapshot_dir):
+        raise BackupError(
+            f"Snapshot {snapshot_dir} already exists. Pick another name."
+        )
+
+    os.makedirs(mirror_dir, exist_ok=True)
+    rmtree(partial_dir, ignore_errors=True)
+
+    # like rsync, only root keeps owners, so only then can they go stale
+    keep_owner = os.geteuid() == 0
+    link_dest = find_link_dest(group, mirror_dir, config_dir)
+    if link_dest is not None:
+        echo(f"Hardlinking unchanged files from {link_dest}.")
+
+    # (source, destination) of directories to copy the metadata of, and of
+    # regular files to copy, with the source's stat
+    dirs: List[Tuple[str, str]] = []
+    files: List[Tuple[str, str, os.stat_result]] = []
+    made_dirs: Set[str] = set()
+
+    def make_parent(dst: str) -> None:
+        parent = osp.dirname(dst)
+        if parent not in made_dirs:
+            os.makedirs(parent, exist_ok=True)
+            made_dirs.add(parent)
+
+    # directories and links are cheap and must come in walk order
+    for path in paths:
+        dst = osp.join(partial_dir, path.lstrip("/"))
+        try:
+            st = os.lstat(path)
+        except FileNotFoundError:
+            echo(f"File {path} not found, skipping.", file=sys.stderr)
+            continue
+
+        if stat.S_ISDIR(st.st_mode):
+            os.makedirs(dst, exist_ok=True)
+            made_dirs.add(dst)
+            dirs.append((path, dst))
+        elif stat.S_ISLNK(st.st_mode):
+            make_parent(dst)
+            os.symlink(os.readlink(path), dst)
+        elif stat.S_ISREG(st.st_mode):
+            make_parent(dst)
+            files.append((path, dst, st))
+        else:
+            echo(
+                f"File {path} is not a regular file, skipping.", file=sys.stderr
+            )
+
+    def mirror_file(job: Tuple[str, str, os.stat_result]) -> Optional[int]:
+        """
+        Returns the number of bytes copied, or None if the file was linked.
+        """
+        path, dst, st = job
+
+        if link_dest is not None:
+            prev = osp.join(link_dest, path.lstrip("/"))
+            try:
+                prev_st = os.lstat(prev)
+                if (
+                    stat.S_ISREG(prev_st.st_mode)
+                    and prev_st.st_size == st.st_size
+                    and prev_st.st_mtime_ns == st.st_mtime_ns
+                    and prev_st.st_mode == st.st_mode
+                    and (
+                        not keep_owner
+                        or (prev_st.st_uid, prev_st.st_gid)
+                        == (st.st_uid, st.st_gid)
+                    )
+                ):
+                    os.link(prev, dst)
+                    return None
+            # no previous file, or too many links to it: copy instead
+            except OSError:
+                pass
+
+        try:
+            return copy_file(path, dst, governor, keep_owner)
+        except FileNotFoundError:
+            echo(f"File {path} not found, skipping.", file=sys.stderr)
+            return 0
+        except PermissionError:
+            raise BackupError(f"File {path} needs elevated permissions. Dying.")
+
+    results = parallel_map(mirror_file, files)
+
+    # directory metadata last, since filling them in changes their mtimes
+    for path, dst in reversed(dirs):
+        copystat(path, dst, follow_symlinks=False)
+
+    os.rename(partial_dir, snapshot_dir)
+    record_snapshot(group, mirror_dir, name, config_dir)
+
+    n_linked = sum(1 for res in results if res is None)
+    n_bytes = sum(res for res in results if res is not None)
+    echo(
+        f"Mirrored {len(files)} files to {snapshot_dir}: "
+        f"{len(files) - n_linked} copied ({n_bytes} bytes), {n_linked} linked."
+    )
+
+    return snapshot_dir
+
+
+def is_safe_member_name(name: str) -> bool:
+    """
+    Checks that an archive member name stays inside the directory it is
+    extracted to.
+    """
+    return not (
+        osp.isabs(name) or name == ".." or name.startswith("../") or not name
+    )
+
+
+def iter_sparse_data(
+    tar: tarfile.TarFile, tarinfo: tarfile.TarInfo
+) -> Generator[Tuple[int, bytes], None, None]:
+    """
+    Reads the data segments of the sparse member just read from a streamed
+    archive, which extractfile cannot do since it would need to seek.
+
+    Yields:
+        (offset in the file, data) chunks.
+    """
+    # the segments are stored in order right after the sparse map
+    tar.fileobj.seek(tarinfo.offset_data)
+    for offset, length in tarinfo.sparse:
+        for start in range(0, length, COPY_CHUNK):
+            yield offset + start, tar.fileobj.read(
+                min(COPY_CHUNK, length - start)
+            )
+
+
+def clear_restore_target(target: str) -> bool:
+    """
+    Removes whatever is at target, except for directories, to make way for a
+    restored file, link or symlink. Like `tar -x`, links are replaced rather
+    than followed, and directories in the way are left alone.
+
+    Returns:
+        whether target is free now.
+    """
+    import stat
+
+    try:
+        st = os.lstat(target)
+    except FileNotFoundError:
+        return True
+
+    if stat.S_ISDIR(st.st_mode):
+        echo(f"Directory {target} is in the way, skipping.", file=sys.stderr)
+        return False
+
+    os.unlink(target)
+    return True
+
+
+def write_restored_file(
+    tar: tarfile.TarFile,
+    tarinfo: tarfile.TarInfo,
+    target: str,
+    chunks: Iterable[bytes],
+    fsync: bool,
+) -> bool:
+    """
+    Writes a restored regular file and applies the member's metadata.
+
+    Args:
+        tar: the archive being restored from.
+        tarinfo: the member being restored.
+        target: the path to restore to, whose parent must exist.
+        chunks: the contents of the member, or (offset, data) pairs for
+            sparse members, see iter_sparse_data.
+        fsync: whether to wait for the file to be on disk.
+
+    Returns:
+        False if the file was skipped, since a directory is in the way.
+    """
+    flags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_NOFOLLOW
+    try:
+        fd = os.open(target, flags, 0o600)
+    except OSError as e:
+        # never write through a link already in the way, or into a directory
+        if e.errno not in (errno.ELOOP, errno.EISDIR):
+            raise
+        if not clear_restore_target(target):
+            return False
+        fd = os.open(target, flags, 0o600)
+
+    with open(fd, "wb") as f:
+        if tarinfo.sparse is not None:
+            # chunks are (offset, data) pairs, holes are left as holes
+            for offset, data in chunks:
+                f.seek(offset)
+                f.write(data)
+            f.truncate(tarinfo.size)
+        else:
+            for data in chunks:
+                f.write(data)
+        if fsync:
+            f.flush()
+            os.fsync(fd)
+
+    tar.chown(tarinfo, target, numeric_owner=False)
+    tar.chmod(tarinfo, target)
+    tar.utime(tarinfo, target)
+    return True
+
+
+def fsync_dir(path: str) -> None:
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def make_path_filter(
+    paths: Iterable[str], matcher: Optional[PathMatcher] = None
+) -> Optional[Callable[[str], bool]]:
+    """
+    Builds a filter for restore_archive.
+
+    Args:
+        paths: if any, only paths at or below these are selected. They are
+            made absolute like for add.
+        matcher: if given, only paths it contains are selected.
+
+    Returns:
+        the filter, or None if everything is selected.
+    """
+    prefixes = [
+        Path(path).expanduser().absolute().as_posix().rstrip("/")
+        for path in paths
+    ]
+    if not prefixes and matcher is None:
+        return None
+
+    def select(path: str) -> bool:
+        if prefixes and not any(
+            path == prefix or path.startswith(prefix + "/")
+            for prefix in prefixes
+        ):
+            return False
+        return matcher is None or path in matcher
+
+    return select
+
+
+def restore_archive(
+    archive: str,
+    dest: str,
+    *,
+    select: Optional[Callable[[str], bool]] = None,
+    workers: int = STAT_WORKERS,
+    fsync: bool = False,
+) -> Tuple[int, int]:
+    """
+    Extracts an archive made by pull, like `tar -x` would.
+
+    The archive is decompressed and read by the calling thread, which hands
+    regular files to a pool of workers for writing, so that the per-file cost
+    of creating files and setting their metadata is paid in parallel. Large
+    and sparse files are written by the reader. Hardlinks, and the metadata
+    of directories, are done last.
+
+    Members that would end up outside of dest, including through links, are
+    skipped. Devices, FIFOs and the like are skipped as well. Hardlinks to
+    files that were not selected are restored as copies of them, which takes
+    a second pass over the archive.
+
+    Args:
+        archive: the archive to restore, in any compression pull supports.
+        dest: the directory to restore into, created if needed. Members keep
+            their full paths beneath it, so restoring to "/" puts files back
+            where they were pulled from.
+        select: if given, only members whose original absolute path it
+            returns True for are restored.
+        workers: the number of threads writing files.
+        fsync: whether to wait for every restored file to be on disk.
+
+    Returns:
+        the number of restored files, and the number of bytes in them.
+    """
+    import tarfile
+    from collections import deque
+    from concurrent.futures import Future, ThreadPoolExecutor
+
+    os.makedirs(dest, exist_ok=True)
+    real_dest = osp.realpath(dest)
+
+    # parents known to exist within dest
+    safe_dirs: Set[str] = set()
+    # (tarinfo, target) of directories to set the metadata of at the end
+    dirs: List[Tuple[tarfile.TarInfo, str]] = []
+    # (tarinfo, target, link target) of hardlinks to make at the end
+    links: List[Tuple[tarfile.TarInfo, str, str]] = []
+    restored: Set[str] = set()
+
+    def make_parent(target: str) -> bool:
+        """
+        Makes the parent directory of target, unless links would lead it
+        outside of dest.
+        """
+        parent = osp.dirname(target)
+        if parent in safe_dirs:
+            return True
+
+        existing = parent
+        while not osp.lexists(existing):
+            existing = osp.dirname(existing)
+        real = osp.realpath(existing)
+        if real != real_dest and not real.startswith(real_dest + "/"):
+            return False
+
+        os.makedirs(parent, exist_ok=True)
+        safe_dirs.add(parent)
+        return True
+
+    n_files = n_bytes = 0
+    # (future, name, size) of files being written by the pool
+    pending: Deque[Tuple[Future, str, int]] = deque()
+    pending_bytes = 0
+
+    def reap(force: bool) -> None:
+        nonlocal pending_bytes, n_files, n_bytes
+        while pending and (
+            force
+            or pending[0][0].done()
+            or pending_bytes > RESTORE_BUFFER
+            or len(pending) > RESTORE_QUEUE
+        ):
+            future, name, size = pending.popleft()
+            if future.result():
+                n_files += 1
+                n_bytes += size
+                restored.add(name)
+            pending_bytes -= size
+
+    with tarfile.open(archive, "r|*") as tar, ThreadPoolExecutor(
+        max_workers=workers
+    ) as pool:
+        try:
+            for tarinfo in tar:
+                name = osp.normpath(tarinfo.name)
+                if select is not None and not select("/" + name):
+                    continue
+                target = osp.join(dest, name)
+                if not (is_safe_member_name(name) and make_parent(target)):
+                    echo(f"Unsafe path {name}, skipping.", file=sys.stderr)
+                    continue
+
+                if tarinfo.isdir():
+                    # anything but a directory, including links to one, is
+                    # replaced
+                    if osp.lexists(target) and (
+                        osp.islink(target) or not osp.isdir(target)
+                    ):
+                        os.unlink(target)
+                    os.makedirs(target, exist_ok=True)
+                    dirs.append((tarinfo, target))
+                    continue
+
+                if tarinfo.issym():
+                    if not clear_restore_target(target):
+                        continue
+                    os.symlink(tarinfo.linkname, target)
+                    tar.chown(tarinfo, target, numeric_owner=False)
+                    restored.add(name)
+                    continue
+                elif tarinfo.islnk():
+                    links.append(
+                        (tarinfo, target, osp.normpath(tarinfo.linkname))
+                    )
+                    continue
+                elif not tarinfo.isreg():
+                    echo(
+                        f"File {name} is not a regular file, skipping.",
+                        file=sys.stderr,
+                    )
+                    continue
+                elif tarinfo.sparse is not None:
+                    written = write_restored_file(
+                        tar,
+                        tarinfo,
+                        target,
+                        iter_sparse_data(tar, tarinfo),
+                        fsync,
+                    )
+
+                elif tarinfo.size > COPY_CHUNK:
+                    fobj = tar.extractfile(tarinfo)
+                    written = write_restored_file(
+                        tar,
+                        tarinfo,
+                        target,
+                        iter(lambda: fobj.read(COPY_CHUNK), b""),
+                        fsync,
+                    )
+
+                else:
+                    data = tar.extractfile(tarinfo).read()
+                    future = pool.submit(
+                        write_restored_file,
+                        tar,
+                        tarinfo,
+                        target,
+                        [data],
+                        fsync,
+                    )
+                    pending.append((future, name, len(data)))
+                    pending_bytes += len(data)
+                    reap(force=False)
+                    continue
+
+                if written:
+                    n_files += 1
+                    n_bytes += tarinfo.size
+                    restored.add(name)
+
+            reap(force=True)
+        except PermissionError as e:
+            raise BackupError(
+                f"File {e.filename} needs elevated permissions. Dying."
+            )
+
+    # links to files that were not selected, as when restoring part of a
+    # deduplicated archive, by the name of the file
+    unrestored: Dict[str, List[str]] = defaultdict(list)
+    for tarinfo, target, link_name in links:
+        if link_name not in restored:
+            unrestored[link_name].append(target)
+            continue
+        if clear_restore_target(target):
+            os.link(osp.join(dest, link_name), target)
+            n_files += 1
+
+    # which costs another pass over the archive, to get their contents
+    if unrestored:
+        with tarfile.open(archive, "r|*") as tar:
+            for tarinfo in tar:
+                link_name = osp.normpath(tarinfo.name)
+                if link_name not in unrestored or not tarinfo.isreg():
+                    continue
+
+                targets = unrestored.pop(link_name)
+                if tarinfo.sparse is not None:
+                    chunks = iter_sparse_data(tar, tarinfo)
+                else:
+                    fobj = tar.extractfile(tarinfo)
+                    chunks = iter(lambda: fobj.read(COPY_CHUNK), b"")
+                # the first target not blocked by a directory gets the data
+                while targets:
+                    first = targets.pop(0)
+                    if write_restored_file(tar, tarinfo, first, chunks, fsync):
+                        n_files += 1
+                        n_bytes += tarinfo.size
+                        break
+                for target in targets:
+                    if clear_restore_target(target):
+                        os.link(first, target)
+                        n_files += 1
+
+                if not unrestored:
+                    break
+
+    for link_name in unrestored:
+        echo(
+            f"Hardlinked file {link_name} is not in the archive, skipping.",
+            file=sys.stderr,
+        )
+
+    # deepest first, since setting the metadata of a parent could lock us out
+    for tarinfo, target in sorted(dirs, key=lambda d: d[1], reverse=True):
+        tar.chown(tarinfo, target, numeric_owner=False)
+        tar.chmod(tarinfo, target)
+        tar.utime(tarinfo, target)
+
+    if fsync:
+        parallel_map(fsync_dir, safe_dirs)
+
+    return n_files, n_bytes
+
+
+class Catalog:
+    """
+    An SQLite index of the files in every pulled archive, kept under
+    CONFIG_DIR, so that finding the archives holding a file does not mean
+    opening them.
+
+    Archives are only listed once finish_archive is called on them, so that
+    interrupted pulls do not show up.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS archives (
+            id INTEGER PRIMARY KEY,
+            grp TEXT NOT NULL,
+            name TEXT NOT NULL,
+            created REAL NOT NULL,
+            complete INTEGER NOT NULL DEFAULT 0
+        );
+        CREATE TABLE IF NOT EXISTS members (
+            archive_id INTEGER NOT NULL
+                REFERENCES archives (id) ON DELETE CASCADE,
+            path TEXT NOT NULL,
+            basename TEXT NOT NULL,
+            size INTEGER,
+            mtime INTEGER,
+            hash TEXT
+        );
+        CREATE INDEX IF NOT EXISTS members_path ON members (path);
+        CREATE INDEX IF NOT EXISTS members_basename ON members (basename);
+        CREATE INDEX IF NOT EXISTS members_archive ON members (archive_id);
+    """
+
+    def __init__(self, config_dir: Optional[Path] = None) -> None:
+        import sqlite3
+
+        self.fp = ensure_config_dir(config_dir).joinpath("catalog.db")
+        self.db = sqlite3.connect(str(self.fp))
+        self.db.execute("PRAGMA foreign_keys = ON")
+        self.db.execute("PRAGMA journal_mode = WAL")
+        self.db.executescript(self.SCHEMA)
+
+    def add_archive(self, group: str, name: str) -> int:
+        with self.db:
+            cursor = self.db.execute(
+                "INSERT INTO archives (grp, name, created) VALUES (?, ?, ?)",
+                (group, name, time.time()),
+            )
+        return cursor.lastrowid
+
+    def add_members(
+        self,
+        archive_id: int,
+        members: Iterable[Tuple[str, tarfile.TarInfo]],
+        hashes: Optional[Dict[str, str]] = None,
+    ) -> None:
+        """
+        Records archived files.
+
+        Args:
+            archive_id: the archive the files are in.
+            members: the archived paths with their headers. Members other
+                than files are skipped.
+            hashes: content hashes of the paths, where known.
+        """
+        hashes = hashes or {}
+        rows = [
+            (
+                archive_id,
+                path,
+                osp.basename(path),
+                # sparse members store less than the file size
+                int(
+                    tarinfo.pax_headers.get("GNU.sparse.realsize", tarinfo.size)
+                ),
+                int(tarinfo.mtime),
+                hashes.get(path),
+            )
+            for path, tarinfo in members
+            if tarinfo.isreg()
+        ]
+        with self.db:
+            self.db.executemany(
+                "INSERT INTO members VALUES (?, ?, ?, ?, ?, ?)", rows
+            )
+
+    def finish_archive(self, archive_id: int) -> None:
+        with self.db:
+            self.db.execute(
+                "UPDATE archives SET complete = 1 WHERE id = ?", (archive_id,)
+            )
+
+    def drop_archive(self, archive_id: int) -> None:
+        with self.db:
+            self.db.execute("DELETE FROM archives WHERE id = ?", (archive_id,))
+
+    def find(
+        self, pattern: str, group: Optional[str] = None, limit: int = 100
+    ) -> List[Tuple[str, str, float, str, int, int, Optional[str]]]:
+        """
+        Finds archived files, newest archives first.
+
+        Args:
+            pattern: a file name, or a path if it contains a "/". Either may
+                use the glob wildcards "*", "?" and "[...]". Patterns without
+                a leading wildcard are answered from an index.
+            group: only search archives of this group.
+            limit: the maximum number of results.
+
+        Returns:
+            (group, archive name, archive creation time, path, size, mtime,
+            hash) tuples.
+        """
+        column = "path" if "/" in pattern else "basename"
+        op = "GLOB" if re.search(r"[*?[]", pattern) else "="
+
+        query = (
+            "SELECT a.grp, a.name, a.created, m.path, m.size, m.mtime, m.hash "
+            "FROM members m JOIN archives a ON a.id = m.archive_id "
+            f"WHERE a.complete AND m.{column} {op} ?"
+        )
+        args: List[Any] = [pattern]
+        if group is not None:
+            query += " AND a.grp = ?"
+            args.append(group)
+        query += " ORDER BY a.created DESC, m.path LIMIT ?"
+        args.append(limit)
+
+        return self.db.execute(query, args).fetchall()
+
+    def close(self) -> None:
+        self.db.close()
+
+
+def add_paths(
+    group: str,
+    paths: Iterable[str],
+    *,
+    exclude=False,
+    allow_nx=False,
+    glob: Optional[bool] = None,
+    config_dir: Optional[Path] = None,
+    restore_backup: Optional[bool] = None,
+    compact: Optional[bool] = None,
+) -> List[str]:
+    """
+    Adds paths to a group, see the add command.
+
+    Args:
+        group: the group to add to.
+        paths: the paths to add.
+        exclude: add the paths as exclusions.
+        allow_nx: keep nonexistent paths, instead of dropping them.
+        glob: whether the paths are globs, decided per path if None.
+        config_dir: the config directory, see ensure_config_dir.
+        restore_backup: see get_group_manifest_file.
+        compact: see commit_group_rps.
+
+    Returns:
+        the paths that were dropped because they do not exist.
+    """
+    group = canonicalize_group_name(group)
+    rps = set(
+        get_group_rps(
+            group, config_dir=config_dir, restore_backup=restore_backup
+        )
+    )
+
+    paths = list(paths)
+    path_globs = [is_glob(path) if glob is None else glob for path in paths]
+
+    # check existence of everything up front, in parallel
+    to_check = [
+        path
+        for path, path_glob in zip(paths, path_globs)
+        if not (allow_nx or path_glob)
+    ]
+    existing = {
+        path
+        for path, exists in zip(
+            to_check,
+            parallel_map(lambda p: osp.isfile(p) or osp.isdir(p), to_check),
+        )
+        if exists
+    }
+
+    new_rps = set()
+    missing = []
+    for path, path_glob in zip(paths, path_globs):
+
+        if not (allow_nx or path_glob or path in existing):
+            missing.append(path)
+            continue
+
+        new_rp = RichPath(
+            path, exclude=exclude, sticky=allow_nx, is_glob=path_glob
+        )
+        new_rps.add(new_rp)
+
+    # order is important, we need to favour the new rps in hash conflicts
+    rps = new_rps | rps
+    commit_group_rps(
+        group,
+        rps,
+        existing=(rp.str for rp in new_rps if not (rp.is_glob or rp.sticky)),
+        config_dir=config_dir,
+        compact=compact,
+    )
+
+    return missing
+
+
+def remove_paths(
+    group: str,
+    regex: str,
+    *,
+    config_dir: Optional[Path] = None,
+    compact: Optional[bool] = None,
+) -> List[RichPath]:
+    """
+    Removes the rich paths matching a regex from a group, see the del
+    command. See commit_group_rps for compact.
+
+    Returns:
+        the removed rich paths.
+    """
+    path_reg = re.compile(regex)
+    rps = get_group_rps(group, config_dir=config_dir)
+
+    removed = [rp for rp in rps if path_reg.search(str(rp))]
+    commit_group_rps(
+        group,
+        [rp for rp in rps if not path_reg.search(str(rp))],
+        config_dir=config_dir,
+        compact=compact,
+    )
+    return removed
+
+
+def resolve_group(
+    rps: Iterable[RichPath], resolve: str = "expand", fs: FileSystem = DISK
+) -> Tuple[List[str], Optional[PathMatcher]]:
+    """
+    Resolves rich paths into the paths to pull, see the pull command's
+    --resolve option.
+
+    Returns:
+        the paths to pass to iter_archive_paths, and the matcher to filter
+        them with, if any.
+    """
+    if resolve == "filter":
+        return gather_include_roots(rps, fs)
+    elif resolve == "expand":
+        return gather_effective_files(rps, fs), None
+    raise BackupError(f'Invalid resolution "{resolve}".')
+
+
+def pull_paths(
+    group: str,
+    file_paths: List[str],
+    matcher: Optional[PathMatcher] = None,
+    *,
+    name: str,
+    compalgo: Optional[str],
+    resume=False,
+    mirror: Optional[str] = None,
+    governor: Optional[PullGovernor] = None,
+    rsyncable=False,
+    catalog: Optional[Catalog] = None,
+    config_dir: Optional[Path] = None,
+    dedup=False,
+    progress: Optional[str] = None,
+) -> Tuple[str, Optional[PullCheckpoint]]:
+    """
+    Archives a resolved group, see the pull command.
+
+    Args:
+        group: the group being pulled.
+        file_paths: the resolved group, see resolve_group.
+        matcher: the matcher the group was resolved with, if any.
+        name: the name of the archive or snapshot, without extensions.
+        compalgo: the compression to use, or None.
+        resume: see write_archive.
+        mirror: if given, make a snapshot under this directory instead, see
+            make_mirror_snapshot.
+        governor: the governor to read files under, if any.
+        rsyncable: see write_archive.
+        catalog: see write_archive.
+        config_dir: the config directory, see ensure_config_dir.
+        dedup: archive files with the same contents as an earlier file as
+            hardlinks to it, see Duplicates.
+        progress: if given, report progress in this mode, see PullProgress.
+            The files are stat'ed up front for this.
+
+    Returns:
+        the path of the archive or snapshot, and the checkpoint to discard
+        once done with the archive, which holds the group's lock until then.
+        There is no checkpoint for snapshots.
+
+    Raises:
+        BackupError: if another pull of the group is running.
+    """
+    import hashlib
+    import stat
+
+    if mirror is not None:
+        if resume:
+            raise BackupError("Resuming does not apply to mirroring.")
+        if dedup:
+            raise BackupError("Deduplication does not apply to mirroring.")
+        if progress is not None:
+            raise BackupError("Progress is not reported for mirroring.")
+        target = make_mirror_snapshot(
+            mirror,
+            name,
+            iter_archive_paths(file_paths, matcher),
+            governor,
+            group=group,
+            config_dir=config_dir,
+        )
+        return target, None
+
+    # taken first, so that a concurrent pull is reported before any work
+    lock_fd = PullCheckpoint.lock(group, config_dir)
+    try:
+        resolve = "expand" if matcher is None else "filter"
+        digest = hashlib.sha1(
+            "\0".join([resolve] + file_paths).encode(errors="surrogateescape")
+        ).hexdigest()
+        paths: Iterable[str] = iter_archive_paths(file_paths, matcher)
+        duplicates: Optional[Duplicates] = None
+        pull_progress: Optional[PullProgress] = None
+        if dedup or progress is not None:
+            paths = list(paths)
+            stats = lstat_paths(paths)
+            if dedup:
+                duplicates = Duplicates.find(paths, governor, stats)
+            if progress is not None:
+                sizes = [
+                    st.st_size if st and stat.S_ISREG(st.st_mode) else 0
+                    for st in stats
+                ]
+                pull_progress = PullProgress(sizes, progress)
+
+        ckpt = write_archive(
+            group,
+            paths,
+            tar_name=f"{name}.tar" + (f".{compalgo}" if compalgo else ""),
+            compalgo=compalgo,
+            digest=digest,
+            resume=resume,
+            governor=governor,
+            rsyncable=rsyncable,
+            catalog=catalog,
+            config_dir=config_dir,
+            duplicates=duplicates,
+            progress=pull_progress,
+        )
+    except BaseException:
+        os.close(lock_fd)
+        raise
+    ckpt.lock_fd = lock_fd
+    return ckpt.tar_fn, ckpt
+
+
+# # # COMMANDS SECTION
+
+
+class BackupCommands(click.Group):
+    """
+    Reports BackupErrors raised by commands, and exits, like die.
+    """
+
+    def invoke(self, ctx: click.Context) -> Any:
+        try:
+            return super().invoke(ctx)
+        except BackupError as e:
+            die(str(e))
+
+
+@click.group(cls=BackupCommands)
+def main() -> None:
+    """
+    Tracks files to be backed up, on a per-group basis.
+
+    The first argument is always the group name, which can be an arbitrary well
+    behaving string which serves as an identifier for the collection of paths
+    added. This allows different backup flow for different files.
+    """
+
+
+@main.command(name="add")
+@click.argument("group", nargs=1)
+@click.argument("paths", nargs=-1)
+@click.option(
+    "--allow-nx",
+    is_flag=True,
+    default=False,
+    help=(
+        "Allows nonexistent entries and persists them until explicit "
+        "deletion. Otherwise, nonexistent entries are dropped."
+    ),
+)
+@click.option(
+    "--exclude",
+    is_flag=True,
+    default=False,
+    help=(
+        "Excludes the file or str. Overrides more general inclusions. "
+        "Overriden by more specific inclusions."
+    ),
+)
+@click.option(
+    "--glob/--no-glob",
+    is_flag=True,
+    default=None,
+    help=(
+        "If true, the str will be interpreted as a glob. If false, it "
+        "will be interpreted literally. If unset, the str will be "
+        'treated as a glob iff it contains an unescaped "*".'
+    ),
+)
+@click.option(
+    "--from-file",
+    type=click.File("r"),
+    default=None,
+    help=(
+        'Also adds the paths listed in the given file, or stdin for "-". '
+        "Paths are separated by NULs if there are any, and by newlines "
+        "otherwise. All paths are committed to the group at once."
+    ),
+)
+def add_files(
+    group: str,
+    paths: Iterable[str],
+    *,
+    exclude,
+    allow_nx,
+    glob,
+    from_file: Optional[TextIO],
+):
+    """
+    Adds a str to be tracked under a group.
+    """
+    paths = list(paths)
+    if from_file is not None:
+        paths += read_path_list(from_file)
+
+    for path in add_paths(
+        group, paths, exclude=exclude, allow_nx=allow_nx, glob=glob
+    ):
+        echo(
+            f'Path "{path}" does not exist. Ignoring. '
+            "Pass --allow-nx to force persistent inclusion."
+        )
+
+
+@main.command("show")
+@click.argument("group")
+@click.option(
+    "--full",
+    is_flag=True,
+    default=False,
+    help="show every included file explicitly",
+)
+def show_files(group: str, *, full) -> None:
+    """
+    Shows all tracked paths for group.
+    """
+    rps = get_group_rps(group, need_exist=True)
+    if not full:
+        for rp in rps:
+            echo(" " + str(rp))
+    else:
+        for fn in gather_effective_files(rps):
+            echo("\t" + fn)
+
+
+@main.command("check")
+@click.argument("group")
+@click.argument("paths", nargs=-1)
+@click.option(
+    "--from-file",
+    type=click.File("r"),
+    default=None,
+    help=(
+        'Also checks the paths listed in the given file, or stdin for "-", '
+        "separated by NULs if there are any, and by newlines otherwise."
+    ),
+)
+@click.pass_context
+def check_paths(
+    ctx, group: str, paths: Iterable[str], *, from_file: Optional[TextIO]
+) -> None:
+    """
+    Checks whether paths are backed up by a group.
+
+    Prints each path prefixed with "+" if it is included and "-" if it is
+    not, and exits with status 1 if any path is not included. Paths need not
+    exist, and the group's globs are matched without listing any
+    directories.
+    """
+    matcher = PathMatcher.compile(get_group_rps(group, need_exist=True))
+
+    paths = list(paths)
+    if from_file is not None:
+        paths += read_path_list(from_file)
+
+    all_included = True
+    for path in paths:
+        abs_path = Path(path).expanduser().absolute().as_posix()
+        included = abs_path in matcher
+        all_included &= included
+        echo(("+ " if included else "- ") + path)
+
+    if not all_included:
+        ctx.exit(1)
+
+
+@main.command(name="del")
+@click.argument("group")
+@click.argument("regex")
+def del_files(group: str, regex: str):
+    """
+    Removes files from group by regex.
+
+    Python's `re.match` is used, so the regexp should match from the
+    beginning of the str. Use ^.* or similar.
+    """
+
+    if regex == "." and click.confirm(
+        '"del ." will delete every file in the group. Did you intend to '
+        "delete the current directory instead?",
+        default=True,
+    ):
+        regex = os.getcwd()
+    elif regex == ".." and click.confirm(
+        '"del .." will likely delete every file in the group. Did you'
+        "intend to delete the current directory instead?",
+        default=True,
+    ):
+        regex = str(Path(os.getcwd()).parent)
+
+    regex.rstrip("/")
+
+    remove_paths(group, regex)
+
+
+@main.command("compact")
+@click.argument("group")
+@click.option(
+    "--dry-run",
+    is_flag=True,
+    default=False,
+    help="only show the changes as a diff of the manifest",
+)
+def compact(group: str, *, dry_run: bool) -> None:
+    """
+    Removes the entries of a group that make no difference.
+
+    These are entries deciding the same as the entries above them, like
+    includes inside included directories and exclusions outside of any
+    include, and globs equivalent to a later glob. Fewer entries make
+    resolving the group faster. Pass --dry-run to see what would be removed.
+    """
+    from difflib import unified_diff
+
+    group = canonicalize_group_name(group)
+    rps = sorted(set(get_group_rps(group, need_exist=True)))
+    kept = compact_rps(rps)
+
+    echo(
+        "".join(
+            unified_diff(
+                [str(rp) + "\n" for rp in rps],
+                [str(rp) + "\n" for rp in kept],
+                fromfile=group,
+                tofile=f"{group} (compacted)",
+            )
+        ),
+        nl=False,
+    )
+    echo(f"{len(rps) - len(kept)} of {len(rps)} entries are redundant.")
+
+    if not dry_run and len(kept) < len(rps):
+        commit_group_rps(
+            group,
+            kept,
+            existing=(rp.str for rp in kept if not rp.is_glob),
+            compact=False,
+        )
+
+
+@main.command()
+@click.argument("group")
+@click.argument("commands", nargs=-1)
+@click.option(
+    "--no-xz",
+    default=False,
+    is_flag=True,
+    help="turn off compression",
+)
+@click.option(
+    "--compalgo",
+    default="gz",
+    help="compression algorithm to use",
+    type=Choice(["xz", "bz2", "gz"], case_sensitive=False),
+)
+@click.option("--name", default=None, help="name to use for the tarball")
+@click.option(
+    "--resolve",
+    default="expand",
+    help=(
+        "how to resolve exclusions under included directories. 'expand' "
+        "splits the included directories up into their children, 'filter' "
+        "keeps the coarse included directories and skips excluded paths "
+        "while archiving. The latter is much cheaper for deep exclusions."
+    ),
+    type=Choice(["expand", "filter"], case_sensitive=False),
+)
+@click.option(
+    "--governed/--ungoverned",
+    default=None,
+    help=(
+        "limit the bandwidth, CPU and I/O priority of the pull as configured "
+        "in the [governor] section of settings.ini. Defaults to the "
+        "'enabled' setting of that section."
+    ),
+)
+@click.option(
+    "--resume",
+    is_flag=True,
+    default=False,
+    help=(
+        "continue the last interrupted pull of the group from its last "
+        "checkpoint, instead of starting over."
+    ),
+)
+@click.option(
+    "--mirror",
+    default=None,
+    type=click.Path(file_okay=False),
+    help=(
+        "instead of a tarball, copy the files into a new snapshot directory "
+        "under the given directory, hardlinking files unchanged since the "
+        "latest snapshot there. The snapshot is kept after the commands run."
+    ),
+)
+@click.option(
+    "--rsyncable",
+    is_flag=True,
+    default=False,
+    help=(
+        "make the tarball deterministic, and restart compression "
+        "periodically, so that pulls of a barely changed group produce "
+        "barely changed tarballs. Costs some compression ratio."
+    ),
+)
+@click.option(
+    "--catalog/--no-catalog",
+    default=True,
+    help="record the archived files in the catalog searched by `find`",
+)
+@click.option(
+    "--dedup",
+    is_flag=True,
+    default=False,
+    help=(
+        "store files with the same contents as an earlier file in the "
+        "tarball as hardlinks to it. Only files of equal size are hashed."
+    ),
+)
+@click.option(
+    "--progress",
+    default=None,
+    type=Choice(PullProgress.MODES, case_sensitive=False),
+    help=(
+        "report throughput and the time left on stderr, as a bar or as "
+        "JSON lines. The files are stat'ed up front to estimate the latter."
+    ),
+)
+def pull(
+    group,
+    commands,
+    *,
+    no_xz,
+    name,
+    compalgo: str,
+    resolve: str,
+    governed: Optional[bool],
+    resume: bool,
+    mirror: Optional[str],
+    rsyncable: bool,
+    catalog: bool,
+    dedup: bool,
+    progress: Optional[str],
+) -> None:
+    """
+    Pulls files into tarball, runs given commands on it.
+
+    First, a tarball containing all of the files in the group is created
+    in the config directory. It is given a sensible default name, which
+    can be overriden with the --name option.
+
+    This action accepts any number of positional parameters, each of which
+    is interpreted as a shell command to run. Within these commands, the
+    string "{}" is expanded to the name of the newly-created tar file.
+
+    After the commands have been executed, the tarfile is deleted.
+
+    With --mirror, the files are instead copied into a snapshot directory,
+    which "{}" expands to, and which is kept.
+
+    Progress is checkpointed while archiving. If the pull is interrupted,
+    rerunning it with --resume continues from the last checkpoint, using the
+    name and compression of the interrupted pull.
+    """
+    from datetime import date
+
+    group = canonicalize_group_name(group)
+
+    if name is None:
+        name = f"backup_{group}_{date.today().isoformat()}"
+
+    rps = get_group_rps(group, need_exist=True)
+    file_paths, matcher = resolve_group(rps, resolve)
+
+    if len(file_paths) == 0 and not click.confirm(
+        f"Group {group} is empty. Continue?", default=False
+    ):
+        return
+
+    settings = load_settings()
+
+    governor: Optional[PullGovernor] = None
+    if governed is None:
+        governed = settings.getboolean(
+            PullGovernor.SECTION, "enabled", fallback=False
+        )
+    if governed:
+        governor = PullGovernor.from_settings(settings)
+        governor.apply_priorities()
+
+    if mirror is not None and resume:
+        die("--resume does not apply to --mirror.")
+    if mirror is not None and dedup:
+        die("--dedup does not apply to --mirror.")
+    if mirror is not None and progress is not None:
+        die("--progress does not apply to --mirror.")
+
+    target, ckpt = pull_paths(
+        group,
+        file_paths,
+        matcher,
+        name=name,
+        compalgo=None if no_xz else compalgo,
+        resume=resume,
+        mirror=mirror,
+        governor=governor,
+        rsyncable=rsyncable,
+        catalog=Catalog() if catalog and mirror is None else None,
+        dedup=dedup,
+        progress=progress,
+    )
+
+    if not commands:
+        try:
+            commands = [settings["py9backup"]["default_pull_command"]]
+            click.echo(
+                "Running default pull commands:\n\t" + "\n\t".join(commands)
+            )
+        except KeyError:
+            commands = []
+
+    for com in commands:
+        com = re.sub(r"{}", target, com)
+        os.system(com)
+
+    if ckpt is not None:
+        ckpt.discard()
+
+
+@main.command("find")
+@click.argument("pattern")
+@click.option("--group", default=None, help="only search this group")
+@click.option(
+    "--limit", default=100, show_default=True, help="maximum results to show"
+)
+def find_files(pattern: str, *, group: Optional[str], limit: int) -> None:
+    """
+    Finds files in the archives of previous pulls.
+
+    The pattern is a file name, or an absolute path if it contains a "/",
+    and may use the glob wildcards "*", "?" and "[...]". Patterns without a
+    leading wildcard are answered from an index, regardless of the number of
+    archives. Newer archives are listed first.
+    """
+    from datetime import datetime
+
+    if group is not None:
+        group = canonicalize_group_name(group)
+
+    catalog = Catalog()
+    try:
+        for grp, name, created, path, size, mtime, digest in catalog.find(
+            pattern, group=group, limit=limit
+        ):
+            created_str = datetime.fromtimestamp(created).strftime(
+                "%Y-%m-%d %H:%M"
+            )
+            mtime_str = datetime.fromtimestamp(mtime).strftime("%Y-%m-%d %H:%M")
+            echo(
+                f"{created_str}\t{grp}\t{name}\t{path}\t{size}\t{mtime_str}"
+                + (f"\t{digest}" if digest else "")
+            )
+    finally:
+        catalog.close()
+
+
+@main.command("restore")
+@click.argument("archive", type=click.Path(exists=True, dir_okay=False))
+@click.argument("paths", nargs=-1)
+@click.option(
+    "--to",
+    "dest",
+    default=".",
+    show_default=True,
+    type=click.Path(file_okay=False),
+    help=(
+        "the directory to restore into. Files keep their full original "
+        'paths beneath it, so "/" puts them back where they were.'
+    ),
+)
+@click.option(
+    "--group",
+    default=None,
+    help="only restore the files the group currently backs up",
+)
+@click.option(
+    "--workers",
+    default=STAT_WORKERS,
+    show_default=True,
+    type=click.IntRange(min=1),
+    help="the number of threads writing files",
+)
+@click.option(
+    "--fsync",
+    is_flag=True,
+    default=False,
+    help="wait for the restored files to be on disk before exiting",
+)
+def restore(
+    archive: str,
+    paths: Iterable[str],
+    *,
+    dest: str,
+    group: Optional[str],
+    workers: int,
+    fsync: bool,
+) -> None:
+    """
+    Restores files from a tarball made by pull.
+
+    If paths are given, only files at or below them are restored. Paths are
+    the original paths of the files, and are made absolute like for add.
+    Files are written by a pool of threads while the tarball is being
+    decompressed, which is much faster than `tar -x` for many small files.
+    """
+    matcher: Optional[PathMatcher] = None
+    if group is not None:
+        matcher = PathMatcher.compile(get_group_rps(group, need_exist=True))
+
+    n_files, n_bytes = restore_archive(
+        archive,
+        dest,
+        select=make_path_filter(paths, matcher),
+        workers=workers,
+        fsync=fsync,
+    )
+    echo(f"Restored {n_files} files ({n_bytes} bytes) to {dest}.")
+
+
+@main.command("list")
+def list_groups() -> None:
+    """
+    List known groups.
+    """
+    for path in sorted(Path(CONFIG_DIR).glob("*.txt")):
+        echo(path.stem)
+
+
+@main.command()
+@click.argument("group")
+@click.option("--drop-backup", default=False, help="also forgets the backup")
+def forget(group: str, drop_backup: bool):
+    """
+    Deletes the registry file for a group. Unless that file itself is
+    backed up (as is recommended), this cannot be undone.
+    """
+
+    def render_lines(lines: List[str]) -> str:
         if len(lines) < 3:
             out = "\n".join(lines)
         else:
@@ -728,11 +3819,10 @@ def rename(ctx, group: str, new_name: str):
 
 
 if __name__ == "__main__":
-    # noinspection PyBroadException
     try:
-        CONFIG_DIR.mkdir(exist_ok=True)
-    except Exception:
-        die(f"Unable to create config directory at {CONFIG_DIR}")
+        ensure_config_dir()
+    except BackupError as e:
+        die(str(e))
 
     # noinspection PyBroadException
     try:
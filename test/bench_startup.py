@@ -0,0 +1,55 @@
+"""
+Benchmarks the startup time of the backup command.
+
+Runs `import py9backup.backup` and the metadata commands in fresh
+interpreters against an empty config directory and reports the median
+wall time of each, next to that of a bare interpreter.
+
+Usage:
+    python test/bench_startup.py [runs]
+"""
+import os
+import subprocess
+import sys
+import time
+from statistics import median
+from tempfile import mkdtemp
+
+BENCHMARKS = {
+    "python": ["-c", "pass"],
+    "import": ["-c", "import py9backup.backup"],
+    "list": ["-m", "py9backup.backup", "list"],
+    "show": ["-m", "py9backup.backup", "show", "bench"],
+}
+
+
+def time_command(args, env, runs: int) -> float:
+    times = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run(
+            [sys.executable, *args],
+            env=env,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            check=False,
+        )
+        times.append(time.perf_counter() - start)
+    return median(times)
+
+
+def main() -> None:
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+
+    env = dict(os.environ, HOME=mkdtemp())
+    config_dir = os.path.join(env["HOME"], ".config", "py9backup")
+    os.makedirs(config_dir)
+    with open(os.path.join(config_dir, "bench.txt"), "w") as f:
+        f.write("      /tmp\n")
+
+    for name, args in BENCHMARKS.items():
+        print(f"{name:>8}: {1000 * time_command(args, env, runs):7.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,19 @@
+import hashlib
+import io
 import os
 import os.path as osp
+import pwd
+import random
 import re
+import subprocess
+import sys
+import tarfile
+import time
 from pathlib import Path
 from shutil import rmtree
 from tempfile import mkdtemp, mkstemp
 
+import pytest
 from click.testing import CliRunner, Result
 
 from py9backup import backup
@@ -243,3 +252,952 @@ def test_rename() -> None:
 
         assert "stuff" not in run("show", "mygroup").output
         assert "xxx" in run("show", "mygroup").output
+
+
+def test_filter_resolution() -> None:
+    with clean_configdir():
+        run("add mygroup ./stuff/")
+        run("add mygroup ./stuff/old/ --exclude")
+        run("add mygroup ./stuff/old/important/")
+        run("add mygroup ./stuff/**/*.bkp --exclude")
+        run("add mygroup ./stuff/archive/**/*.bkp")
+        run("add mygroup ./stuff/old/important/special.bkp")
+        run("add mygroup ./stuff/**/interesting/")
+
+        rps = backup.get_group_rps("mygroup")
+        roots, matcher = backup.gather_include_roots(rps)
+        assert roots == [osp.join(TEST_DIR, "stuff")] + [
+            osp.join(TEST_DIR, "stuff", sub)
+            for sub in ["old/a/b/c/interesting", "old/important"]
+        ]
+
+        def files(paths):
+            return {p for p in paths if osp.isfile(p)}
+
+        expanded = backup.iter_archive_paths(backup.gather_effective_files(rps))
+        filtered = backup.iter_archive_paths(roots, matcher)
+        assert files(filtered) == files(expanded)
+
+        with tempshellfns() as (ofn, efn):
+            run(
+                "pull",
+                "mygroup",
+                "--no-xz",
+                "--resolve",
+                "filter",
+                f"tar -tf {{}} 1>{ofn} 2>{efn}",
+            )
+            with open(ofn) as f:
+                shell_out = f.read()
+
+        assert "/stuff/new/some.file" in shell_out
+        assert "/stuff/old/some.file" not in shell_out
+        assert "/stuff/old/important/some.file" in shell_out
+        assert "/stuff/old/important/some.bkp" not in shell_out
+        assert "/stuff/archive/2018/store.bkp" in shell_out
+        assert "/stuff/old/important/special.bkp" in shell_out
+        assert "/stuff/old/a/b/c/interesting/some.bkp" not in shell_out
+        assert "/stuff/old/a/b/c/interesting/some.file" in shell_out
+
+    # "proj/**" also expands to "proj/", which has to be the same as "proj"
+    src_dir = mkdtemp()
+    try:
+        proj = osp.join(src_dir, "proj")
+        os.makedirs(osp.join(proj, "sub"))
+        for fn in [".hidden", "keep.txt", "other.txt", "sub/deep.txt"]:
+            Path(proj, fn).touch()
+
+        with clean_configdir():
+            run("add", "proj", proj)
+            run("add", "proj", osp.join(proj, "**"), "--exclude")
+            run("add", "proj", osp.join(proj, "keep.txt"))
+
+            rps = backup.get_group_rps("proj")
+            roots, matcher = backup.gather_include_roots(rps)
+            expanded = list(
+                backup.iter_archive_paths(backup.gather_effective_files(rps))
+            )
+            filtered = list(backup.iter_archive_paths(roots, matcher))
+            assert filtered == expanded == [osp.join(proj, "keep.txt")]
+    finally:
+        rmtree(src_dir)
+
+
+def test_lazy_imports() -> None:
+    # the metadata commands should not pay for the archiving machinery
+    script = (
+        "import sys\n"
+        "from py9backup import backup\n"
+        "backup.main(['list'], standalone_mode=False)\n"
+        "print(' '.join(sorted(sys.modules)))\n"
+    )
+    # what the standard library loads by itself, e.g. pathlib imports glob
+    # since Python 3.13
+    baseline_script = (
+        "import sys, pathlib, click\nprint(' '.join(sorted(sys.modules)))\n"
+    )
+    with clean_configdir() as mock_dir:
+        out, baseline = (
+            subprocess.run(
+                [sys.executable, "-c", code],
+                env=dict(os.environ, HOME=mock_dir),
+                cwd=osp.dirname(TEST_DIR),
+                stdout=subprocess.PIPE,
+                check=True,
+            ).stdout.decode()
+            for code in [script, baseline_script]
+        )
+
+    loaded = set(out.split()) - set(baseline.split())
+    for module in ["tarfile", "tempfile", "configparser", "glob", "heapq"]:
+        assert module not in loaded
+
+
+def test_add_from_file() -> None:
+    with clean_configdir():
+        paths = ["./testdir/a/", "./testdir/root.txt", "./testdir/nx.txt"]
+
+        run(
+            "add",
+            "test",
+            "./stuff/",
+            "--from-file",
+            "-",
+            input="\n".join(paths),
+        )
+        out = run("show", "test").output
+        assert "testdir/a" in out
+        assert "testdir/root.txt" in out
+        assert "stuff" in out
+        assert "nx.txt" not in out
+
+        paths = ["./testdir/b/b1/foo.txt", "./testdir/**/*.png"]
+        run("add", "test", "--from-file", "-", input="\0".join(paths) + "\0")
+        out = run("show", "test").output
+        assert "foo.txt" in out
+        assert re.compile(r" +g +[^ ]+\*\*\/\*.png").search(out)
+        # only globs are flagged as such
+        assert not re.compile(r" +g +[^ ]+foo.txt").search(out)
+
+
+def test_governed_pull() -> None:
+    assert backup.parse_size("512") == 512
+    assert backup.parse_size("20M") == 20 << 20
+    assert backup.parse_size("1.5kb") == 1536
+
+    governor = backup.PullGovernor(read_limit=10 << 20)
+    start = time.monotonic()
+    governor.throttle(1 << 20)
+    assert time.monotonic() - start >= 0.09
+
+    with clean_configdir() as mock_dir:
+        with open(osp.join(mock_dir, "settings.ini"), "w") as f:
+            f.write("[governor]\nread_limit = 1M\ncpu_limit = 0.5\n")
+
+        run("add test ./testdir/")
+        with tempshellfns() as (ofn, efn):
+            run("pull", "test", "--governed", f"tar -tzf {{}} 1>{ofn} 2>{efn}")
+            with open(ofn) as f:
+                shell_out = f.read()
+            assert "bar.png" in shell_out
+            assert "foo.txt" in shell_out
+
+        # bad settings are reported, not crashed on
+        for bad in ["read_limit = 0", "io_level = 8", "cpu_limit = 0"]:
+            with open(osp.join(mock_dir, "settings.ini"), "w") as f:
+                f.write(f"[governor]\n{bad}\n")
+            out = run(
+                "pull",
+                "test",
+                "--governed",
+                "true",
+                asrt=backup.DIE_CODE,
+                noex=False,
+            )
+            assert f"Invalid {bad.split()[0]}" in out.output
+
+
+def test_resume_pull() -> None:
+    def list_tar(tar_fn):
+        with tarfile.open(tar_fn, "r:*") as tar:
+            return tar.getnames()
+
+    with clean_configdir():
+        run("add test ./testdir/")
+        run("add test ./stuff/")
+
+        with tempshellfns() as (ofn, efn):
+            run("pull", "test", "--name", "full", f"cp {{}} {ofn}")
+            full = list_tar(ofn)
+
+        old_ckpt_bytes = backup.CHECKPOINT_BYTES
+        old_add = backup.add_archive_member
+        n_added = 0
+
+        def failing_add(*args, **kwargs):
+            nonlocal n_added
+            n_added += 1
+            if n_added > 10:
+                raise KeyboardInterrupt
+            old_add(*args, **kwargs)
+
+        # checkpoint after every member, and die after the tenth
+        backup.CHECKPOINT_BYTES = 0
+        backup.add_archive_member = failing_add
+        try:
+            run(
+                "pull",
+                "test",
+                "--name",
+                "resumed",
+                "echo {}",
+                asrt=1,
+                noex=False,
+            )
+        finally:
+            backup.CHECKPOINT_BYTES = old_ckpt_bytes
+            backup.add_archive_member = old_add
+
+        ckpt = backup.PullCheckpoint.load("test")
+        assert ckpt.n_done == 10
+        assert not ckpt.complete
+        # kept where reboots do not clear it
+        assert ckpt.tar_fn.startswith(str(backup.CONFIG_DIR))
+
+        with tempshellfns() as (ofn, efn):
+            run("pull", "test", "--resume", f"cp {{}} {ofn}")
+            # multiple compressed segments should read like a single one
+            assert list_tar(ofn) == full
+
+        assert backup.PullCheckpoint.load("test") is None
+        assert not osp.exists(osp.dirname(ckpt.tar_fn))
+
+
+def test_concurrent_pull() -> None:
+    # the first pull runs in another process, holding the lock while its
+    # commands run
+    script = (
+        "import sys\n"
+        "from pathlib import Path\n"
+        "from py9backup import backup\n"
+        "backup.CONFIG_DIR = Path(sys.argv[1])\n"
+        "backup.main(['pull', 'test', *sys.argv[2:]])\n"
+    )
+    out_dir = mkdtemp()
+    try:
+        started = osp.join(out_dir, "started")
+        tar_fn = osp.join(out_dir, "first.tar.gz")
+        with clean_configdir() as mock_dir:
+            run("add test ./testdir/")
+            first = subprocess.Popen(
+                [
+                    sys.executable,
+                    "-c",
+                    script,
+                    mock_dir,
+                    f"touch {started}; sleep 2; cp {{}} {tar_fn}",
+                ],
+                cwd=osp.dirname(TEST_DIR),
+            )
+            try:
+                while not osp.exists(started):
+                    assert first.poll() is None
+                    time.sleep(0.05)
+
+                out = run(
+                    "pull", "test", "true", asrt=backup.DIE_CODE, noex=False
+                )
+                assert "already running" in out.output
+            finally:
+                assert first.wait() == 0
+
+            # the first pull's archive survived the second pull
+            with tarfile.open(tar_fn) as tar:
+                assert tar.getnames()
+            run("pull", "test", "true")
+    finally:
+        rmtree(out_dir)
+
+
+def test_sparse_pull() -> None:
+    src_dir = mkdtemp()
+    out_dir = mkdtemp()
+    try:
+        sparse_fn = osp.join(src_dir, "sparse.img")
+        with open(sparse_fn, "wb") as f:
+            f.seek(16 << 20)
+            f.write(b"middle")
+            f.truncate(64 << 20)
+        with open(osp.join(src_dir, "dense.txt"), "wb") as f:
+            f.write(os.urandom(100_000))
+
+        with clean_configdir():
+            run("add", "test", src_dir)
+            tar_fn = osp.join(out_dir, "out.tar")
+            run("pull", "test", "--no-xz", f"cp {{}} {tar_fn}")
+
+        assert osp.getsize(tar_fn) < 1 << 20
+
+        with tarfile.open(tar_fn) as tar:
+            tar.extractall(osp.join(out_dir, "py"))
+        subprocess.run(
+            ["tar", "-xf", tar_fn, "-C", out_dir, "--one-top-level=gnu"],
+            check=True,
+        )
+        for extracted in ["py", "gnu"]:
+            extracted_dir = osp.join(out_dir, extracted + src_dir)
+            for fn in ["sparse.img", "dense.txt"]:
+                with open(osp.join(src_dir, fn), "rb") as f:
+                    want = f.read()
+                with open(osp.join(extracted_dir, fn), "rb") as f:
+                    assert f.read() == want
+    finally:
+        rmtree(src_dir)
+        rmtree(out_dir)
+
+
+def test_archive_member() -> None:
+    # members are written without TarFile.addfile, which wants the data
+    src_dir = mkdtemp()
+    out_dir = mkdtemp()
+    try:
+        contents = {
+            "empty": b"",
+            "small": b"x" * 1000,
+            "big": os.urandom(3 << 20),
+        }
+        for fn, data in contents.items():
+            with open(osp.join(src_dir, fn), "wb") as f:
+                f.write(data)
+
+        tar_fn = osp.join(out_dir, "out.tar.gz")
+        with backup.ArchiveSink(tar_fn, "gz") as sink, tarfile.open(
+            fileobj=sink, mode="w"
+        ) as tar:
+            for fn in contents:
+                backup.add_archive_member(tar, osp.join(src_dir, fn))
+            assert tar.offset == sink.tell()
+            assert [osp.basename(m.name) for m in tar.getmembers()] == list(
+                contents
+            )
+
+        with tarfile.open(tar_fn) as tar:
+            for member in tar:
+                assert (
+                    tar.extractfile(member).read()
+                    == contents[osp.basename(member.name)]
+                )
+    finally:
+        rmtree(src_dir)
+        rmtree(out_dir)
+
+
+def test_mirror_pull() -> None:
+    src_dir = mkdtemp()
+    mirror_dir = mkdtemp()
+    try:
+        os.makedirs(osp.join(src_dir, "sub"))
+        for fn in ["same.txt", "sub/changed.txt", "chmod.txt", "chown.txt"]:
+            with open(osp.join(src_dir, fn), "w") as f:
+                f.write(fn)
+        os.symlink("same.txt", osp.join(src_dir, "link"))
+        # owners are only kept, and compared, as root
+        as_root = os.geteuid() == 0
+
+        with clean_configdir():
+            run("add", "test", src_dir)
+            run("pull", "test", "--mirror", mirror_dir, "--name", "first")
+            # snapshots of other groups in the same directory are not linked
+            # against, even if newer
+            run("add", "other", osp.join(src_dir, "sub"))
+            run("pull", "other", "--mirror", mirror_dir, "--name", "other")
+
+            with open(osp.join(src_dir, "sub/changed.txt"), "w") as f:
+                f.write("changed!")
+            os.utime(osp.join(src_dir, "sub/changed.txt"), (0, 0))
+            os.chmod(osp.join(src_dir, "chmod.txt"), 0o600)
+            if as_root:
+                os.chown(osp.join(src_dir, "chown.txt"), 1234, 1234)
+
+            run("pull", "test", "--mirror", mirror_dir, "--name", "second")
+
+        def snap(name, fn):
+            return osp.join(mirror_dir, name, src_dir.lstrip("/"), fn)
+
+        assert sorted(os.listdir(mirror_dir)) == ["first", "other", "second"]
+        assert os.readlink(snap("second", "link")) == "same.txt"
+        assert os.stat(snap("first", "same.txt")).st_ino == (
+            os.stat(snap("second", "same.txt")).st_ino
+        )
+        assert os.stat(snap("first", "sub/changed.txt")).st_ino != (
+            os.stat(snap("second", "sub/changed.txt")).st_ino
+        )
+        with open(snap("second", "sub/changed.txt")) as f:
+            assert f.read() == "changed!"
+        assert os.stat(snap("second", "sub/changed.txt")).st_mtime == 0
+
+        # metadata changes are not hidden by linking to the old copy
+        assert os.stat(snap("first", "chmod.txt")).st_mode & 0o777 != 0o600
+        assert os.stat(snap("second", "chmod.txt")).st_mode & 0o777 == 0o600
+        if as_root:
+            chown_st = os.stat(snap("second", "chown.txt"))
+            assert (chown_st.st_uid, chown_st.st_gid) == (1234, 1234)
+
+        # unrecorded snapshots are recognized by their default names
+        old_dir = osp.join(mirror_dir, "unrecorded")
+        for snap_name in ["backup_test_2020-01-01", "backup_test_x_2021-01-01"]:
+            os.makedirs(osp.join(old_dir, snap_name))
+        assert backup.find_link_dest(
+            "test", old_dir, Path(old_dir)
+        ) == osp.join(old_dir, "backup_test_2020-01-01")
+    finally:
+        rmtree(src_dir)
+        rmtree(mirror_dir)
+
+
+def test_rsyncable_pull() -> None:
+    # sync points depend on the (random) paths, so sync often enough for the
+    # changed region to stay small with near certainty
+    old_interval = backup.RSYNC_MEMBER_INTERVAL
+    backup.RSYNC_MEMBER_INTERVAL = 4
+
+    src_dir = mkdtemp()
+    try:
+        rng = random.Random(0)
+        words = ["backup", "tarball", "group", "manifest", "glob", "path"]
+        for ix in range(400):
+            with open(osp.join(src_dir, f"{ix:04d}.txt"), "w") as f:
+                f.write(" ".join(rng.choice(words) for _ in range(500)))
+
+        def pull_bytes(*args):
+            with tempshellfns() as (ofn, _):
+                run("pull", "test", *args, f"cp {{}} {ofn}")
+                with open(ofn, "rb") as f:
+                    return f.read()
+
+        def n_changed(old, new):
+            # the gzip trailer holds a checksum of everything
+            old, new = old[:-8], new[:-8]
+            prefix = len(osp.commonprefix([old, new]))
+            suffix = len(osp.commonprefix([old[::-1], new[::-1]]))
+            return max(len(new) - prefix - suffix, 0)
+
+        with clean_configdir():
+            run("add", "test", src_dir)
+            plain = pull_bytes()
+            old = pull_bytes("--rsyncable")
+            # deterministic
+            assert pull_bytes("--rsyncable") == old
+            # without dropping owners
+            with tarfile.open(fileobj=io.BytesIO(old)) as tar:
+                owners = {(m.uid, m.uname) for m in tar}
+            assert owners == {(os.getuid(), pwd.getpwuid(os.getuid()).pw_name)}
+
+            with open(osp.join(src_dir, "0001.txt"), "a") as f:
+                f.write("appended")
+
+            new = pull_bytes("--rsyncable")
+            assert n_changed(old, new) < len(new) // 10
+            assert n_changed(plain, pull_bytes()) > len(new) // 2
+    finally:
+        backup.RSYNC_MEMBER_INTERVAL = old_interval
+        rmtree(src_dir)
+
+
+def test_compiled_matcher() -> None:
+    def walk(root):
+        for dirpath, dirnames, filenames in os.walk(root):
+            yield dirpath
+            for fn in dirnames + filenames:
+                yield osp.join(dirpath, fn)
+
+    with clean_configdir():
+        run("add mygroup ./stuff/")
+        run("add mygroup ./stuff/old/ --exclude")
+        run("add mygroup ./stuff/old/important/")
+        run("add mygroup ./stuff/**/*.bkp --exclude")
+        run("add mygroup ./stuff/archive/**/*.bkp")
+        run("add mygroup ./stuff/old/important/special.bkp")
+        run("add mygroup ./stuff/**/interesting/")
+        run("add mygroup ./testdir/**/*.png")
+        run("add mygroup ./testdir/b/b2/ --exclude")
+        run("add mygroup ./testdir/b/b2/bar.png")
+        run("add mygroup ./weird/**/wat/ --exclude")
+        run("add mygroup ./weird/**/wat/wat/")
+
+        rps = backup.get_group_rps("mygroup")
+        roots, expanded = backup.gather_include_roots(rps)
+        compiled = backup.PathMatcher.compile(rps)
+
+        resolved = {
+            path
+            for path in backup.iter_archive_paths(roots, expanded)
+            if osp.isfile(path)
+        }
+        assert osp.join(TEST_DIR, "testdir/b/b2/bar.png") in resolved
+
+        for root in ["stuff", "testdir", "weird"]:
+            for path in walk(osp.join(TEST_DIR, root)):
+                if osp.isfile(path):
+                    assert (path in compiled) == (path in resolved), path
+
+        # only globs rooted above a path are tried on it
+        tried = compiled._globs_above(osp.join(TEST_DIR, "testdir/b/b2"))
+        assert [glob.prefix for glob in tried] == [
+            osp.join(TEST_DIR, "testdir")
+        ]
+
+        out = run(
+            "check",
+            "mygroup",
+            "./stuff/new/some.file",
+            "./stuff/old/not_yet_there.file",
+            "--from-file",
+            "-",
+            input="./stuff/old/important/some.bkp\n./testdir/new.png\n",
+            asrt=1,
+            noex=False,
+        ).output
+        assert out.split("\n") == [
+            "+ ./stuff/new/some.file",
+            "- ./stuff/old/not_yet_there.file",
+            "- ./stuff/old/important/some.bkp",
+            "+ ./testdir/new.png",
+            "",
+        ]
+
+    # "dir/**" matches dir itself, and check agrees with what pull archives
+    src_dir = mkdtemp()
+    try:
+        for sub in ["proj", "all"]:
+            os.makedirs(osp.join(src_dir, sub, "sub"))
+            for fn in [".hidden", "keep.txt", "sub/.deep"]:
+                Path(src_dir, sub, fn).touch()
+        proj = osp.join(src_dir, "proj")
+
+        with clean_configdir():
+            run("add", "mygroup", proj)
+            run("add", "mygroup", osp.join(proj, "**"), "--exclude")
+            run("add", "mygroup", osp.join(proj, "keep.txt"))
+            run("add", "mygroup", osp.join(src_dir, "all", "**"))
+
+            rps = backup.get_group_rps("mygroup")
+            compiled = backup.PathMatcher.compile(rps)
+            pulled = set(
+                backup.iter_archive_paths(backup.gather_effective_files(rps))
+            )
+            for path in walk(src_dir):
+                assert (path in compiled) == (path in pulled), path
+            assert osp.join(src_dir, "all/sub/.deep") in pulled
+            assert osp.join(proj, ".hidden") not in pulled
+    finally:
+        rmtree(src_dir)
+
+
+def test_catalog() -> None:
+    with clean_configdir():
+        run("add test ./testdir/")
+        run("pull", "test", "--name", "first", "true")
+        run("add test ./stuff/")
+        run("pull", "test", "--name", "second", "true")
+        run("pull", "test", "--name", "uncataloged", "--no-catalog", "true")
+
+        out = run("find", "foo.txt").output.strip().split("\n")
+        assert [line.split("\t")[2] for line in out] == [
+            "second.tar.gz",
+            "first.tar.gz",
+        ]
+        assert out[0].split("\t")[3] == osp.join(
+            TEST_DIR, "testdir/b/b1/foo.txt"
+        )
+
+        out = run("find", "*.bkp").output
+        assert "first" not in out
+        assert "store.bkp" in out
+
+        out = run("find", osp.join(TEST_DIR, "stuff/old/*")).output
+        assert "old/important/some.file" in out
+        assert "testdir" not in out
+
+        assert run("find", "--group", "other", "foo.txt").output == ""
+
+        # interrupted pulls are not listed, and dropped when discarded
+        old_add = backup.add_archive_member
+
+        def failing_add(*args, **kwargs):
+            raise KeyboardInterrupt
+
+        backup.add_archive_member = failing_add
+        try:
+            run("pull", "test", "--name", "failed", "true", asrt=1, noex=False)
+        finally:
+            backup.add_archive_member = old_add
+
+        assert "failed" not in run("find", "foo.txt").output
+        run("pull", "test", "--name", "third", "true")
+        catalog = backup.Catalog()
+        names = [
+            name for (name,) in catalog.db.execute("SELECT name FROM archives")
+        ]
+        catalog.close()
+        assert names == ["first.tar.gz", "second.tar.gz", "third.tar.gz"]
+
+
+def test_library_api() -> None:
+    from py9backup.api import Backup
+
+    config_dir = mkdtemp()
+    out_dir = mkdtemp()
+    try:
+        bk = Backup(config_dir)
+        group = bk.group("Lib")
+        assert bk.groups() == []
+
+        # errors are raised, not exited on
+        with pytest.raises(backup.BackupError):
+            group.rich_paths()
+        with pytest.raises(backup.BackupError):
+            bk.group("no way")
+
+        assert group.add(["./testdir/", "./testdir/nx.txt"]) == [
+            "./testdir/nx.txt"
+        ]
+        group.add(["./testdir/a/"], exclude=True)
+        assert bk.groups() == ["lib"]
+        assert "./testdir/root.txt" in group
+        assert "./testdir/a/a1" not in group
+
+        files = group.files()
+        assert osp.join(TEST_DIR, "testdir/b/b1/foo.txt") in files
+        assert not any("/testdir/a/" in fn for fn in files)
+        # resolution is cached until the caches are cleared
+        assert bk.fs.listings
+
+        tar_fn = group.pull(out_dir, name="lib", resolve="filter")
+        assert tar_fn == osp.join(out_dir, "lib.tar.gz")
+        with tarfile.open(tar_fn) as tar:
+            assert len(tar.getnames()) == len(files)
+        with pytest.raises(backup.BackupError):
+            group.pull(out_dir, name="lib")
+
+        # pulls do not miss files created after the caches warmed up
+        late_dir = mkdtemp(dir=out_dir)
+        os.mkdir(osp.join(late_dir, "skip"))
+        group.add([late_dir])
+        # splits late_dir around the exclusion, listing it
+        group.add([osp.join(late_dir, "skip")], exclude=True)
+        group.resolve()
+        late_fn = osp.join(late_dir, "late", "late.txt")
+        os.mkdir(osp.dirname(late_fn))
+        Path(late_fn).touch()
+        assert late_fn not in group.files()
+        with tarfile.open(group.pull(out_dir, name="late")) as tar:
+            assert late_fn.lstrip("/") in tar.getnames()
+        group.remove(re.escape(late_dir))
+
+        # manifest changes are picked up, by this process or others
+        removed = group.remove("testdir/a")
+        assert [rp.raw_entry for rp in removed] == [
+            osp.join(TEST_DIR, "testdir/a")
+        ]
+        assert "./testdir/a/a1" in group
+
+        bk.clear_caches()
+        assert not bk.fs.listings
+
+        group.forget()
+        assert not group.exists
+        assert not backup.CONFIG_DIR.joinpath("lib.txt").exists()
+
+        # settings passed in are used instead of settings.ini
+        import configparser
+
+        settings = configparser.ConfigParser()
+        settings.read_string("[py9backup]\nauto_compact = yes\n")
+        own_dir = osp.join(out_dir, "own")
+        group = Backup(own_dir, settings=settings).group("lib")
+        group.add(["./testdir/", "./testdir/b/"])
+        assert [rp.raw_entry for rp in group.rich_paths()] == [
+            osp.join(TEST_DIR, "testdir")
+        ]
+        assert not osp.exists(osp.join(own_dir, "settings.ini"))
+    finally:
+        rmtree(config_dir)
+        rmtree(out_dir)
+
+
+def test_restore() -> None:
+    src_dir = mkdtemp()
+    out_dir = mkdtemp()
+    try:
+        os.makedirs(osp.join(src_dir, "sub"))
+        contents = {}
+        for ix in range(300):
+            contents[f"sub/small_{ix}.txt"] = os.urandom(ix * 10)
+        contents["big.bin"] = os.urandom(3 << 20)
+        for fn, data in contents.items():
+            with open(osp.join(src_dir, fn), "wb") as f:
+                f.write(data)
+        with open(osp.join(src_dir, "sparse.img"), "wb") as f:
+            f.seek(8 << 20)
+            f.write(b"middle")
+        contents["sparse.img"] = b"\0" * (8 << 20) + b"middle"
+        os.symlink("big.bin", osp.join(src_dir, "link"))
+        os.symlink("sub", osp.join(src_dir, "dirlink"))
+        os.chmod(osp.join(src_dir, "sub/small_1.txt"), 0o640)
+        os.utime(osp.join(src_dir, "sub"), (1_000_000, 1_000_000))
+
+        tar_fn = osp.join(out_dir, "out.tar.gz")
+        with clean_configdir():
+            run("add", "test", src_dir)
+            run("pull", "test", f"cp {{}} {tar_fn}")
+            run("add", "test", osp.join(src_dir, "sub/small_2*"), "--exclude")
+
+            full_dir = osp.join(out_dir, "full")
+            restored = full_dir + src_dir
+            # restoring again replaces the files, and links to directories
+            for _ in range(2):
+                run("restore", tar_fn, "--to", full_dir, "--workers", "4")
+                for fn, data in contents.items():
+                    with open(osp.join(restored, fn), "rb") as f:
+                        assert f.read() == data
+                assert os.readlink(osp.join(restored, "link")) == "big.bin"
+                assert os.readlink(osp.join(restored, "dirlink")) == "sub"
+            sparse_st = os.stat(osp.join(restored, "sparse.img"))
+            assert sparse_st.st_blocks * 512 < sparse_st.st_size
+            small_st = os.stat(osp.join(restored, "sub/small_1.txt"))
+            assert small_st.st_mode & 0o777 == 0o640
+            assert os.stat(osp.join(restored, "sub")).st_mtime == 1_000_000
+
+            # directories in the way of files are left alone, like tar -x does
+            for fn in ["big.bin", "sub/small_3.txt"]:
+                os.unlink(osp.join(restored, fn))
+                os.mkdir(osp.join(restored, fn))
+            out = run("restore", tar_fn, "--to", full_dir)
+            assert out.output.count("is in the way") == 2
+            assert osp.isdir(osp.join(restored, "big.bin"))
+
+            # restoring a subtree, filtered by the group's current rules
+            part_dir = osp.join(out_dir, "part")
+            run(
+                "restore",
+                tar_fn,
+                osp.join(src_dir, "sub"),
+                "--to",
+                part_dir,
+                "--group",
+                "test",
+            )
+            restored = part_dir + src_dir
+            assert not osp.exists(osp.join(restored, "big.bin"))
+            assert sorted(os.listdir(osp.join(restored, "sub"))) == sorted(
+                osp.basename(fn)
+                for fn in contents
+                if fn.startswith("sub/") and not fn.startswith("sub/small_2")
+            )
+
+        # members escaping the destination are never written
+        evil_fn = osp.join(out_dir, "evil.tar")
+        with tarfile.open(evil_fn, "w") as tar:
+            link = tarfile.TarInfo("escape")
+            link.type = tarfile.SYMTYPE
+            link.linkname = out_dir
+            tar.addfile(link)
+            for name in ["escape/evil.txt", "../evil.txt"]:
+                tar.addfile(tarfile.TarInfo(name))
+        with clean_configdir():
+            run("restore", evil_fn, "--to", osp.join(out_dir, "evil"))
+        assert not osp.exists(osp.join(out_dir, "evil.txt"))
+    finally:
+        rmtree(src_dir)
+        rmtree(out_dir)
+
+
+def test_dedup_pull() -> None:
+    src_dir = mkdtemp()
+    out_dir = mkdtemp()
+    try:
+        data = os.urandom(200_000)
+        contents = {
+            "a/orig.bin": data,
+            "b/copy.bin": data,
+            "b/copy2.bin": data,
+            # same size, different contents
+            "b/decoy.bin": os.urandom(len(data)),
+        }
+        for fn, file_data in contents.items():
+            os.makedirs(osp.join(src_dir, osp.dirname(fn)), exist_ok=True)
+            with open(osp.join(src_dir, fn), "wb") as f:
+                f.write(file_data)
+
+        plain_fn = osp.join(out_dir, "plain.tar")
+        dedup_fn = osp.join(out_dir, "dedup.tar")
+        with clean_configdir():
+            run("add", "test", src_dir)
+            run("pull", "test", "--no-xz", f"cp {{}} {plain_fn}")
+            run("pull", "test", "--no-xz", "--dedup", f"cp {{}} {dedup_fn}")
+
+            assert osp.getsize(dedup_fn) < osp.getsize(plain_fn) - 300_000
+            with tarfile.open(dedup_fn) as tar:
+                links = {
+                    member.name: member.linkname
+                    for member in tar
+                    if member.islnk()
+                }
+            orig_name = osp.join(src_dir, "a/orig.bin").lstrip("/")
+            assert links == {
+                osp.join(src_dir, fn).lstrip("/"): orig_name
+                for fn in ["b/copy.bin", "b/copy2.bin"]
+            }
+
+            # the copies are found and hashed in the catalog
+            found = run("find", "copy.bin").output.split("\n")[0].split("\t")
+            assert found[4] == str(len(data))
+            assert found[-1] == hashlib.sha256(data).hexdigest()
+
+            # plain tar extracts the links
+            subprocess.run(["tar", "-xf", dedup_fn, "-C", out_dir], check=True)
+            for fn, file_data in contents.items():
+                with open(osp.join(out_dir + src_dir, fn), "rb") as f:
+                    assert f.read() == file_data
+
+            # as does restore, even without the original
+            part_dir = osp.join(out_dir, "part")
+            run(
+                "restore",
+                dedup_fn,
+                osp.join(src_dir, "b"),
+                "--to",
+                part_dir,
+            )
+            for fn in ["b/copy.bin", "b/copy2.bin"]:
+                with open(osp.join(part_dir + src_dir, fn), "rb") as f:
+                    assert f.read() == data
+            assert not osp.exists(osp.join(part_dir + src_dir, "a"))
+
+        # a same-size rewrite keeping the mtime is not linked to the original
+        orig_fn, copy_fn = (
+            osp.join(src_dir, fn) for fn in ["a/orig.bin", "b/copy.bin"]
+        )
+        dups = backup.Duplicates.find([orig_fn, copy_fn])
+        dups.archived.add(orig_fn)
+        assert dups.link_target(copy_fn) == orig_fn
+        st = os.stat(copy_fn)
+        time.sleep(0.05)
+        with open(copy_fn, "wb") as f:
+            f.write(os.urandom(len(data)))
+        os.utime(copy_fn, ns=(st.st_atime_ns, st.st_mtime_ns))
+        assert dups.link_target(copy_fn) is None
+    finally:
+        rmtree(src_dir)
+        rmtree(out_dir)
+
+
+def test_compact() -> None:
+    with clean_configdir() as mock_dir:
+        run("add mygroup ./stuff/")
+        run("add mygroup ./stuff/old/ --exclude")
+        run("add mygroup ./stuff/old/important/")
+        run("add mygroup ./stuff/**/*.bkp --exclude")
+        run("add mygroup ./stuff/archive/**/*.bkp")
+        run("add mygroup ./stuff/old/important/special.bkp")
+        run("add mygroup ./stuff/**/interesting/")
+        # redundant entries
+        run("add mygroup ./stuff/new/")
+        run("add mygroup ./stuff/old/a/ --exclude")
+        run("add mygroup ./testdir/b/ --exclude")
+        run("add mygroup ./stuff/**/**/interesting/")
+
+        before = run("show mygroup").output
+        full_before = run("show mygroup --full").output
+        all_paths = [
+            osp.join(root, name)
+            for top in ["./stuff", "./testdir"]
+            for root, dirs, files in os.walk(top)
+            for name in dirs + files
+        ]
+        checked_before = run(
+            "check", "mygroup", *all_paths, asrt=None, noex=False
+        ).output
+
+        out = run("compact mygroup --dry-run").output
+        removed = [
+            line
+            for line in out.split("\n")
+            if line.startswith("-") and not line.startswith("---")
+        ]
+        assert sorted(line.split("/")[-1] for line in removed) == [
+            "a",
+            "b",
+            "interesting",
+            "new",
+        ]
+        assert "**/**/interesting" in "\n".join(removed)
+        assert "4 of 11 entries are redundant." in out
+        assert run("show mygroup").output == before
+
+        run("compact mygroup")
+        assert len(run("show mygroup").output.strip().split("\n")) == 7
+        assert run("show mygroup --full").output == full_before
+        assert (
+            run("check", "mygroup", *all_paths, asrt=None, noex=False).output
+            == checked_before
+        )
+        assert "0 of 7" in run("compact mygroup").output
+
+        # compacting on every commit
+        with open(osp.join(mock_dir, "settings.ini"), "w") as f:
+            f.write("[py9backup]\nauto_compact = yes\n")
+        run("add mygroup ./stuff/new/some.file")
+        assert "some.file" not in run("show mygroup").output
+
+
+def test_pull_progress() -> None:
+    import json
+
+    src_dir = mkdtemp()
+    out_dir = mkdtemp()
+    interval = backup.PROGRESS_INTERVAL
+    try:
+        for ix in range(20):
+            with open(osp.join(src_dir, f"f{ix}"), "wb") as f:
+                f.write(b"x" * 1000 * ix)
+
+        tar_fn = osp.join(out_dir, "out.tar.gz")
+        backup.PROGRESS_INTERVAL = 0
+        with clean_configdir():
+            run("add", "test", src_dir)
+            out = run("pull", "test", "--progress", "json", f"cp {{}} {tar_fn}")
+            reports = [
+                json.loads(line)
+                for line in out.output.splitlines()
+                if line.startswith("{")
+            ]
+            assert len(reports) > 1
+            last = reports[-1]
+            assert last["done"]
+            assert last["files"] == last["total_files"]
+            assert last["bytes_read"] == last["total_bytes"] == 190_000
+            assert last["bytes_written"] == osp.getsize(tar_fn)
+            assert last["ratio"] > 1
+            assert [r["files"] for r in reports] == sorted(
+                r["files"] for r in reports
+            )
+
+            out = run("pull", "test", "--progress", "bar", f"cp {{}} {tar_fn}")
+            assert "100%" in out.output and "ETA 0:00:00" in out.output
+
+            run(
+                "pull",
+                "test",
+                "--progress",
+                "json",
+                "--mirror",
+                out_dir,
+                asrt=backup.DIE_CODE,
+                noex=False,
+            )
+    finally:
+        backup.PROGRESS_INTERVAL = interval
+        rmtree(src_dir)
+        rmtree(out_dir)